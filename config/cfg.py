@@ -1,7 +1,36 @@
+import os
+
 essential_columns = [
     'title', 'author', 'date', 'keywords', 'subject areas', 'abstract'
 ]
 
+cache = {
+    'enabled': True,
+    'db_name': 'cache/responses.db',
+    'ttl': 30 * 24 * 60 * 60, # seconds
+    'max_size': 2 * 1024 ** 3, # bytes, least recently used responses are evicted beyond
+    'scopus_refresh': 30 # days, pybliometrics keeps its own file cache
+}
+
+pipeline = {
+    # stages of one source that may run at the same time, each connector limits its own requests within a stage
+    'limits': {'scopus': 1, 'springer': 1, 'arxiv': 1, 'acm': 1, 'scholar': 1, 'crossref': 1, 'semantic_scholar': 1},
+    'stream_buffer': 1000, # items a streaming stage may be ahead of its slowest dependent
+    'checkpoint_db': 'cache/checkpoints.db' # stage results by fingerprint, None to run every stage
+}
+
+dedupe = {
+    'shingle_size': 4, # characters per title shingle
+    'num_perm': 64, # minhash permutations, signatures are split into bands of num_perm / bands rows
+    'bands': 16,
+    'threshold': 0.7, # estimated title similarity of a duplicate
+    'year_tolerance': 1, # preprints and their published versions can be a year apart
+    'seed': 1,
+    # fields of the canonical record are taken from the first source that has them
+    'source_priority': ['scopus', 'ieee', 'acm', 'springer', 'crossref', 'semantic_scholar', 'arxiv'],
+    'results_table': 'records'
+}
+
 
 scopus = {
     'field_mapping' : {
@@ -38,6 +67,32 @@ scopus = {
             'abstract': 'description', # MISSING
             'cited_by_count': 'citedby_count' # MISSING
         }
+    },
+    'abstract_retrieval': {
+        # keys are taken from config.keys apikey['scopus'] (list), pybliometrics' own config otherwise
+        'max_workers': 8,
+        'requests_per_second': 9, # per key
+        'weekly_quota': 10000, # per key
+        'checkpoint_table': 'abstract_retrieval_checkpoint',
+        'key_usage_table': 'scopus_key_usage'
+    },
+    'snowball': {
+        'directions': ['backward'], # 'backward' (references) and/or 'forward' (citing documents)
+        'budget': None, # maximum number of abstract retrievals per run, None for unlimited
+        # results, visited and frontier tables are suffixed with the id of a snowball search, edges are shared
+        'results_table': 'snowball_results',
+        'edges_table': 'snowball_edges',
+        'visited_table': 'snowball_visited',
+        'frontier_table': 'snowball_frontier'
+    },
+    # native filters of filter.selection_criteria.InclusionCriteria, see there for the names of document types
+    'inclusion_criteria': {
+        'native': ('years', 'document_types', 'languages'), # PUBYEAR, DOCTYPE and LANGUAGE in the query
+        'document_types': {
+            'article': 'ar', 'conference_paper': 'cp', 'book_chapter': 'ch', 'book': 'bk', 'review': 're',
+            'conference_review': 'cr', 'editorial': 'ed', 'letter': 'le', 'note': 'no', 'erratum': 'er'
+        },
+        'languages': {'en': 'english', 'de': 'german', 'fr': 'french', 'es': 'spanish', 'zh': 'chinese'}
     }
 }
 
@@ -66,8 +121,20 @@ arxiv = {
         },
     },
     'category_taxonomy': {
-        'db_name': r"C:\\Repositories\\_Data\SLR\\arxiv_category_taxonomy.db",
-        'table_name': 'category_taxonomy'
+        # bundled with the code, refresh_arxiv_category_taxonomy updates it from the url
+        'file': os.path.join(os.path.dirname(__file__), 'arxiv_category_taxonomy.csv'),
+        'url': 'https://arxiv.org/category_taxonomy'
+    },
+    'harvest': {
+        'page_size': 500, # results per api request, also the unit results are stored and checkpointed in
+        'delay_seconds': 3, # between api requests as asked for by arxiv
+        'num_retries': 5,
+        'progress_table': 'harvest_progress'
+    },
+    'inclusion_criteria': {
+        'native': ('years',), # submittedDate range in the query
+        'document_types': {'preprint': 'preprint'},
+        'languages': {}
     }
 }
 
@@ -87,7 +154,7 @@ crossref = {
             'subject_areas': 'subject',
             'open_access': 'openaccess', # MISSING
             'funded_by': 'funder', # TODO list of dicts, parse values from 'name
-            'abstract': 'description', # MISSING
+            'abstract': 'abstract', # jats xml
             'cited_by_count': 'is-referenced-by-count',
             'language': 'language'
         }, # TODO check how to map crossref (differentiation between search_results and references probably unnecessary)
@@ -104,11 +171,22 @@ crossref = {
             'keywords': 'authkeywords', # MISSING
             'open_access': 'openaccess', # MISSING
             'funded_by': 'funder', # TODO list of dicts, parse values from 'name
-            'abstract': 'description', # MISSING
+            'abstract': 'abstract', # jats xml
             'cited_by_count': 'is-referenced-by-count', # MISSING
             'language': 'language'
         }
-    }
+    },
+    # rest api used for batch enrichment, the polite pool is used when a mailto address is set
+    'api_url': 'https://api.crossref.org/works',
+    'mailto': None,
+    'requests_per_second': 40,
+    'max_workers': 8,
+    'max_retries': 3,
+    'retry_delay': 2, # seconds, multiplied by the attempt number
+    'doi_batch_size': 50, # dois per filter=doi:... request
+    'rows': 20, # candidates per bibliographic query
+    # fields returned by the api, everything else of a work is left out of the response
+    'select': ['DOI', 'title', 'author', 'type', 'container-title', 'short-container-title', 'issued', 'subject', 'funder', 'is-referenced-by-count', 'abstract', 'published']
 }
 
 
@@ -150,6 +228,81 @@ semantic_scholar = {
             'cited_by_count': 'citationCount', # correct 
             'language': 'language'
         }
+    },
+    'batch_size': 500, # maximum number of ids per paper batch request
+    'batch_excluded_fields': ['citations', 'references'], # one entry per citing or cited paper, not requested with the paper data
+    'max_workers': 4,
+    'max_retries': 3,
+    'retry_delay': 5 # seconds, multiplied by the attempt number
+}
+
+ieee = {
+    'field_mapping' : {
+        'search_results': {
+            'title': 'title',
+            'identifier': 'article_number',
+            'doi': 'doi',
+            'subtype': 'content_type', # 'Conferences', 'Journals', ...
+            'publication_name': 'publication_title',
+            'author': 'authors', # {'authors': [{'full_name': ...}, ...]}
+            'date': 'publication_date',
+            'keywords': 'index_terms', # {'author_terms': {'terms': [...]}, 'ieee_terms': {...}}
+            'open_access': 'access_type',
+            'abstract': 'abstract',
+            'cited_by_count': 'citing_paper_count',
+            'url': 'html_url'
+        }
+    },
+    # transport of the xplore api client
+    'connect_timeout': 10, # seconds
+    'timeout': 60, # seconds per request
+    'max_connections': 4, # concurrent requests of queryAPIMany
+    # quota of the api key, pages of iterateArticles are fetched within it
+    'requests_per_second': 10,
+    'max_pages': 200, # api calls per iteration, the default key allows 200 calls per day
+    'inclusion_criteria': {
+        'native': ('years',), # start_year and end_year, content_type takes one type and is checked locally as well
+        'document_types': {
+            'article': 'Journals', 'conference_paper': 'Conferences', 'book_chapter': 'Books', 'book': 'Books',
+            'magazine': 'Magazines', 'standard': 'Standards', 'early_access': 'Early Access'
+        },
+        'languages': {}
+    }
+}
+
+acm = {
+    'field_mapping' : {
+        'search_results': {
+            'title': 'title',
+            'identifier': 'doi',
+            'doi': 'doi',
+            'subtype': 'publication_type', # 'RESEARCH-ARTICLE'
+            'publication_name': 'publication',
+            'author': 'authors', # list of strings
+            'country': None,
+            'date': 'date',
+            'keywords': 'keywords',
+            'subject_areas': 'subjects',
+            'abstract': 'abstract'
+        }
+    },
+    'base_url': 'https://dl.acm.org',
+    # 'local': read the rendered page source once and parse it with lxml, 'webdriver': read every field through the browser
+    'extraction_mode': 'local',
+    'checkpoint_table': 'search_results', # prefix of the tables of finished items per search url, keyed on doi, a restarted run skips them
+    'browser_pool': {
+        'size': 4, # concurrent headless browser sessions
+        'headless': True,
+        'max_uses': 100, # pages loaded by a session before it is recycled
+        'page_load_timeout': 30 # seconds
+    },
+    'inclusion_criteria': {
+        'native': ('years',), # AfterYear and BeforeYear of the advanced search
+        'document_types': {
+            'article': 'RESEARCH-ARTICLE', 'conference_paper': 'RESEARCH-ARTICLE', 'review': 'REVIEW-ARTICLE',
+            'short_paper': 'SHORT-PAPER', 'editorial': 'EDITORIAL', 'book_chapter': 'CHAPTER', 'book': 'BOOK'
+        },
+        'languages': {}
     }
 }
 
@@ -176,7 +329,16 @@ springer = {
             # 'publisher': 'publisher', # 'Springer' TODO maybe use later
             # 'genre': 'genre', # 'OriginalPaper' TODO maybe use later
         }
+    },
+    # quota of the API key, pages beyond the first are fetched concurrently within it
+    'requests_per_second': 1,
+    'max_concurrent_requests': 4,
+    'max_retries': 3,
+    'retry_delay': 5, # seconds, multiplied by the attempt number
+    'inclusion_criteria': {
+        'native': ('years', 'languages'), # year: and language: constraints, type: only knows Journal and Book
+        'document_types': {'article': 'Article', 'conference_paper': 'ConferencePaper', 'book_chapter': 'Chapter', 'book': 'Book'},
+        'languages': {'en': 'en', 'de': 'de', 'fr': 'fr', 'es': 'es', 'zh': 'zh'},
+        'open_years': False # year: matches single years, a range without a first year is checked locally
     }
-
-   
 }
\ No newline at end of file
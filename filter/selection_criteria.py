@@ -0,0 +1,91 @@
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import Tuple
+from utils.records import SOURCE_CONFIGS, record_year
+from utils.utils import setup_logger
+
+logger = setup_logger('selection_criteria', r'.\\logs\\selection_criteria.log', level=logging.INFO)
+
+SELECTION_CRITERIA_VERSION = 2
+
+# Inclusion criteria of a review, declared once and translated by every connector into the filters of its API
+# (see 'inclusion_criteria' of the sources in config/cfg.py). Criteria a source cannot filter on are checked
+# locally on the downloaded records; missing metadata never excludes a record.
+# Document types: 'article', 'conference_paper', 'book_chapter', 'book', 'review', 'conference_review',
+# 'editorial', 'letter', 'note', 'erratum', 'preprint', 'standard', 'magazine', 'early_access', 'short_paper'.
+# Languages are two letter codes, e.g. 'en'.
+
+
+@dataclass(frozen=True)
+class InclusionCriteria:
+    year_low: int = None
+    year_high: int = None
+    document_types: Tuple[str, ...] = None
+    languages: Tuple[str, ...] = None
+    include_patents: bool = False
+
+    @property
+    def years(self):
+        # (first, last) year, an open end is the current year
+        if self.year_low is None and self.year_high is None:
+            return None
+        return self.year_low, self.year_high or datetime.date.today().year
+
+    def is_set(self, criterion):
+        return {'years': self.years, 'document_types': self.document_types, 'languages': self.languages}[criterion] is not None
+
+    def native_criteria(self, source):
+        # criteria applied by the API of source
+        settings = SOURCE_CONFIGS[source].get('inclusion_criteria', {})
+        criteria = [criterion for criterion in settings.get('native', ()) if self.is_set(criterion)]
+        if self.year_low is None and not settings.get('open_years', True):
+            criteria = [criterion for criterion in criteria if criterion != 'years']
+        return criteria
+
+    def has_document_types(self, source):
+        # sources without a document type mapping, e.g. crossref, cannot be checked on document types
+        return bool(SOURCE_CONFIGS[source].get('inclusion_criteria', {}).get('document_types'))
+
+    def native_document_types(self, source):
+        # document types of source for the selected types, e.g. ['ar', 'cp'] for scopus
+        mapping = SOURCE_CONFIGS[source].get('inclusion_criteria', {}).get('document_types', {})
+        return list(dict.fromkeys(mapping[document_type] for document_type in self.document_types or () if document_type in mapping))
+
+    def native_languages(self, source):
+        mapping = SOURCE_CONFIGS[source].get('inclusion_criteria', {}).get('languages', {})
+        return list(dict.fromkeys(mapping[language] for language in self.languages or () if language in mapping))
+
+    def native_filters(self, source):
+        # criteria values the API of source filters on, the searches depend on these and not on the others
+        values = {'years': self.years, 'document_types': self.native_document_types(source), 'languages': self.native_languages(source)}
+        return {criterion: values[criterion] for criterion in self.native_criteria(source)}
+
+    def local_criteria(self, source):
+        native = set(self.native_criteria(source))
+        return [criterion for criterion in ('years', 'document_types', 'languages') if self.is_set(criterion) and criterion not in native]
+
+    def matches(self, record, criteria=None):
+        # checks a utils.records.Record on the criteria its source did not apply
+        for criterion in self.local_criteria(record.source) if criteria is None else criteria:
+            if criterion == 'years':
+                year = record_year(record)
+                year_low, year_high = self.years
+                if year is not None and (year_low is not None and year < year_low or year_high is not None and year > year_high):
+                    return False
+            elif criterion == 'document_types' and record.subtype and self.has_document_types(record.source):
+                allowed = [str(value).lower() for value in self.native_document_types(record.source)]
+                subtype = str(record.subtype).lower()
+                # e.g. springer 'Chapter ConferencePaper' is a chapter and a conference paper
+                if not any(value == subtype or value in subtype.split() for value in allowed):
+                    return False
+            elif criterion == 'languages' and record.language:
+                language = str(record.language).lower()
+                allowed = {language for language in self.languages} | {value.lower() for value in self.native_languages(record.source)}
+                # 'eng' and 'english' are 'en'
+                if language not in allowed and language[:2] not in allowed:
+                    return False
+        return True
+
+    def filter(self, records):
+        return (record for record in records if self.matches(record))
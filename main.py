@@ -1,7 +1,9 @@
 # from scholarly import scholarly
 # from scholarly import ProxyGenerator
+import itertools
 import logging
 import numpy as np
+import pandas as pd
 from crossref.restful import Works
 from semanticscholar import SemanticScholar
 from ratelimiter import RateLimiter
@@ -12,6 +14,10 @@ from utils.semantic_scholar import *
 from utils.acm import *
 from utils.arxiv import *
 from utils.springer import *
+from utils.records import to_records
+from utils.dedupe import *
+from utils.pipeline import Pipeline
+from filter.selection_criteria import InclusionCriteria, SELECTION_CRITERIA_VERSION
 from config import cfg
 
 logger = setup_logger('main', r'.\\logs\\main.log', level=logging.INFO)
@@ -41,52 +47,95 @@ search_string = f"({methodology_substring}) AND ({process_substring}) AND ({prod
 search_string = f"({methodology_substring}) AND ({product_substring} OR {process_substring}) AND ({application_substring})" # testweise
 arxiv_search_string = f"({methodology_substring}) AND ({process_substring_arxiv}) {not_disease_substring} AND ({product_substring}) AND ({application_substring})"
 
-# wip springer api
-title_keyword_results = get_title_keyword_results(search_string)
-terms_title_keyword_results_dict = get_term_title_keyword_results(search_string)
-all_fields_results = get_all_results(search_string)
-terms_regex_dict = convert_search_string_to_regex(search_string)
-springer_tite_abs_key_results = combine_results_to_TITLE_ABS_KEY(all_fields_results, title_keyword_results, terms_title_keyword_results_dict, terms_regex_dict)
+# Define inclusion criteria, applied by the databases where their api supports it and locally otherwise
+criteria = InclusionCriteria(
+    year_low=2010,
+    year_high=None,
+    document_types=('article', 'conference_paper', 'book_chapter', 'book', 'review', 'preprint'),
+    languages=('en',),
+    include_patents=False
+)
 
+# Define databases
 springer_db = r"C:\\Repositories\\_Data\SLR\\springer.db"
-store_springer_results_in_sqlite(springer_db, "search_results", springer_tite_abs_key_results)
-print('Springer search results stored in sqlite')
+arxiv_db = r"C:\\Repositories\\_Data\SLR\\arxiv.db"
+acm_db = r"C:\\Repositories\\_Data\SLR\\acm.db"
+scopus_db = r"C:\\Repositories\\_Data\SLR\\scopus.db"
+combined_db = r"C:\\Repositories\\_Data\SLR\\combined.db"
+db_crossref = r"C:\\cross_ref.db"
+db_scholar = r"C:\\scholar.db"
+
+# Define search parameters for scholar
+include_citations = True
+sort_by = 'relevance' # 'relevance', 'date', 'citations'
+
+# The databases are searched at the same time, each branch runs search -> store -> enrich and the
+# branches meet in dedupe -> select -> export. Stages of one source share its limit in cfg.pipeline['limits'].
+# Stage results are stored in cfg.pipeline['checkpoint_db'] and reused while the search string, the criteria
+# the database filters on and the connector version stay the same, criteria checked locally only re-run select.
+pipeline = Pipeline(limits=cfg.pipeline['limits'], stream_buffer=cfg.pipeline['stream_buffer'], checkpoint_db=cfg.pipeline['checkpoint_db'])
+
+# wip springer api
+@pipeline.stage(resource='springer', params={'search_string': search_string, 'filters': criteria.native_filters('springer')}, version=SPRINGER_CONNECTOR_VERSION)
+def springer_search():
+    title_keyword_results = get_title_keyword_results(search_string, criteria)
+    terms_title_keyword_results_dict = get_term_title_keyword_results(search_string, criteria)
+    all_fields_results = get_all_results(search_string, criteria)
+    abstract_matcher = BooleanQueryMatcher(search_string)
+    springer_tite_abs_key_results = combine_results_to_TITLE_ABS_KEY(all_fields_results, title_keyword_results, terms_title_keyword_results_dict, abstract_matcher)
+    return springer_tite_abs_key_results
+
+@pipeline.stage(inputs=['springer_search'], version=SPRINGER_CONNECTOR_VERSION)
+def springer_store(springer_results):
+    store_springer_results_in_sqlite(springer_db, "search_results", springer_results)
+    logger.info('Springer search results stored in sqlite')
+    return list(to_records('springer', springer_results))
 
 # wip arxiv
-category_taxonomy_df = load_arxiv_category_taxonomy_db()
-
-# Construct the default API client.
-client = arxiv.Client()
-arxiv_query = build_arxiv_query(search_string)
-# Create arxiv search
-search = arxiv.Search(
-  query = arxiv_query,
-#   max_results = 10,
-  sort_by = arxiv.SortCriterion.SubmittedDate
-)
-# exhaust results into a list
-results_arxiv = list(client.results(search))
-# store arxiv search results in sqlite
-arxiv_db = r"C:\\Repositories\\_Data\SLR\\arxiv.db"
-store_arxiv_results_in_sqlite(arxiv_db, "search_results", results_arxiv, category_taxonomy_df)#, mode='replace', id_column=None)
+@pipeline.stage(resource='arxiv', params={'search_string': search_string, 'filters': criteria.native_filters('arxiv')}, version=ARXIV_CONNECTOR_VERSION)
+def arxiv_harvest():
+    category_taxonomy_df = load_arxiv_category_taxonomy()
+    arxiv_query = build_arxiv_query(search_string, criteria)
+    # stream arxiv search results into sqlite, an interrupted harvest resumes at the last stored page
+    harvest_arxiv(arxiv_db, "search_results", arxiv_query, category_taxonomy_df)
+    return get_arxiv_harvest_table("search_results", arxiv_query)
+
+@pipeline.stage(inputs=['arxiv_harvest'], version=ARXIV_CONNECTOR_VERSION)
+def arxiv_store(harvest_table):
+    return list(load_stored_records(arxiv_db, harvest_table, 'arxiv', kind=None))
 
 # works
-acm_results = []
-acm_url = build_acm_search_url(search_string)
-scrape_acm_search_results(acm_url, acm_results)
+@pipeline.stage(resource='acm', params={'search_string': search_string, 'filters': criteria.native_filters('acm')}, version=ACM_CONNECTOR_VERSION)
+def acm_search():
+    acm_url = build_acm_search_url(search_string, criteria)
+    # finished items are checkpointed in acm_db while the pages are scraped
+    return scrape_acm_search_results(acm_url, acm_db)
 
-# Define database
-scopus_db = r"C:\\Repositories\\_Data\SLR\\scopus.db"
+@pipeline.stage(inputs=['acm_search'], version=ACM_CONNECTOR_VERSION)
+def acm_store(acm_results_df):
+    return list(to_records('acm', acm_results_df))
 
 # Query scopus
-search_string_scopus = convert_search_string_to_scopus(search_string)
-scopus_results = search_scopus(search_string_scopus)
-# store scopus search results in sqlite
-scopus_results_df = store_scopus_results_in_sqlite(scopus_db, 'search_results', scopus_results)
-abstract_retrieval_df = retrieve_scopus_abstracts_from_search_results(scopus_results_df, scopus_db, backward_search_iteration=0)
-
-scopus_results_df = scopus_results_df.merge(abstract_retrieval_df, on='eid', how='left')
-scopus_results_df = remove_irrelevant_scopus_search_results(scopus_results_df)
+@pipeline.stage(resource='scopus', params={'search_string': search_string, 'filters': criteria.native_filters('scopus')}, version=SCOPUS_CONNECTOR_VERSION)
+def scopus_search():
+    search_string_scopus = convert_search_string_to_scopus(search_string, criteria)
+    return pd.DataFrame(search_scopus(search_string_scopus))
+
+@pipeline.stage(inputs=['scopus_search'], resource='scopus', version=SCOPUS_CONNECTOR_VERSION)
+def scopus_store(scopus_results_df):
+    # store scopus search results in sqlite
+    store_scopus_results_in_sqlite(scopus_db, 'search_results', scopus_results_df)
+    abstract_retrieval_df = retrieve_scopus_abstracts_from_search_results(scopus_results_df, scopus_db, backward_search_iteration=0)
+    scopus_results_df = scopus_results_df.merge(abstract_retrieval_df, on='eid', how='left')
+    return remove_irrelevant_scopus_search_results(scopus_results_df)
+
+snowball_prefilter_args = {'year_low': criteria.year_low, 'year_high': criteria.year_high, 'subtypes': criteria.native_document_types('scopus')}
+
+@pipeline.stage(inputs=['scopus_store'], resource='scopus', params=snowball_prefilter_args, version=SCOPUS_CONNECTOR_VERSION)
+def scopus_snowball(scopus_results_df):
+    # snowball from the relevant search results, candidates outside the inclusion criteria are not retrieved
+    snowball_prefilter = build_snowball_prefilter(**snowball_prefilter_args)
+    return snowball_scopus(scopus_results_df['eid'], scopus_db, prefilter=snowball_prefilter, scope=snowball_prefilter_args)
 
 # get dict_items where the value of cfg.essential_columns is are in cfg.scopus['field_mapping']['search_results'].keys()
 important_columns = {}
@@ -94,69 +143,70 @@ for element in cfg.scopus['field_mapping']['search_results'].items():
     if element[0] in cfg.essential_columns:
         important_columns[element[0]] = element[1]
 
-fill_missing_values_using_crossref(works, scopus_results_df, important_columns)
-fill_missing_values_using_semantic_scholar(ss, scopus_results_df, important_columns)
-regex = convert_search_string_to_regex(search_string)
-
-# Define search parameters for scholar
-include_patens = False
-include_citations = True
-year_low = 2010
-year_high = None
-sort_by = 'relevance' # 'relevance', 'date', 'citations'
-
-db_crossref = r"C:\\cross_ref.db"
-db_scholar = r"C:\\scholar.db"
-
-
-# cross_ref_results_list = []
-# cross_ref_results = works.query(bibliographic=query)
-# for item in cross_ref_results.filter(from_pub_date=year_low):
-#     cross_ref_results_list.append(item)
-# store_dicts_in_sqlite_with_pandas(db, 'crossref', cross_ref_results)
-
-# Search
-search_query_results = query_scholarly(query=search_string,
-                                       patents=include_patens,
-                                       citations=include_citations,
-                                       year_low=year_low,
-                                       year_high=year_high,
-                                       sort_by=sort_by)
-
-results_scholar = []
-results_crossref = []
-results_crossref_filtered = []
-results = []
-scholar_only = []
-
-for pub in search_query_results:
-    # scholarly.pprint(pub)
-    # pub = scholarly.fill(pub)
-    title = pub['bib']['title']
-    year = pub['bib']['pub_year']
-    author = pub['bib']['author']
-    logging.info(f'Processing {title} {author} {year}')
-
-    # Get DOI using crossref
-    cref_res = call_crossref(works, title, author, year)
-    if cref_res:
-        results_crossref.append(cref_res)
-    else:
-        logging.warning(f'No crossref results found for {title} {author} {year}')
-        pub = scholarly.fill(pub)
-        logging.info('Using Google Scholar only')
-        scholar_only.append(pub)
-
-store_dicts_in_sqlite_with_pandas(db_crossref, 'crossref', results_crossref)
-store_dicts_in_sqlite_with_pandas(db_scholar, 'scholar', scholar_only)
-    # for item in cref_res:
-    #     print(item)
-    # if len(cref_res) > 1:
-    #     print('More than one result')
-    # else:
-    #     cref_res = cref_res[0]
-    # doi = cref_res['DOI']
-
-    # pub = scholarly.fill(pub)
-    # scholarly.pprint(pub)
-
+@pipeline.stage(inputs=['scopus_store'], resource='crossref', params=important_columns, version=CROSSREF_CONNECTOR_VERSION)
+def scopus_enrich_crossref(scopus_results_df):
+    scopus_results_df = scopus_results_df.copy()
+    fill_missing_values_using_crossref(scopus_results_df, important_columns)
+    return scopus_results_df
+
+@pipeline.stage(inputs=['scopus_enrich_crossref'], resource='semantic_scholar', params=important_columns, version=SEMANTIC_SCHOLAR_CONNECTOR_VERSION)
+def scopus_enrich_semantic_scholar(scopus_results_df):
+    fill_missing_values_using_semantic_scholar(ss, scopus_results_df, important_columns)
+    return list(to_records('scopus', scopus_results_df))
+
+# Search google scholar, publications are matched with crossref while the next result pages are loaded
+scholar_args = {
+    'query': search_string, 'patents': criteria.include_patents, 'citations': include_citations,
+    'year_low': criteria.year_low, 'year_high': criteria.year_high, 'sort_by': sort_by
+}
+
+@pipeline.stage(resource='scholar', stream=True, params=scholar_args, version=SCHOLAR_CONNECTOR_VERSION)
+def scholar_search():
+    return query_scholarly(**scholar_args)
+
+@pipeline.stage(inputs=['scholar_search'], resource='crossref', version=CROSSREF_CONNECTOR_VERSION)
+def scholar_crossref(search_query_results):
+    results_crossref = []
+    scholar_only = []
+    for pub in search_query_results:
+        # scholarly.pprint(pub)
+        # pub = scholarly.fill(pub)
+        title = pub['bib']['title']
+        year = pub['bib']['pub_year']
+        author = pub['bib']['author']
+        logger.info(f'Processing {title} {author} {year}')
+
+        # Get DOI using crossref
+        cref_res = call_crossref(works, title, author, year)
+        if cref_res:
+            results_crossref.append(cref_res)
+        else:
+            logger.warning(f'No crossref results found for {title} {author} {year}')
+            pub = scholarly.fill(pub)
+            logger.info('Using Google Scholar only')
+            scholar_only.append(pub)
+
+    store_dicts_in_sqlite_with_pandas(db_crossref, 'crossref', results_crossref)
+    store_dicts_in_sqlite_with_pandas(db_scholar, 'scholar', scholar_only)
+    return list(to_records('crossref', results_crossref))
+
+# merge the results of all sources, a paper found by several sources is kept once with its provenance
+# a database that could not be searched is left out instead of stopping the merge
+@pipeline.stage(inputs=['scopus_enrich_semantic_scholar', 'springer_store', 'arxiv_store', 'acm_store', 'scholar_crossref'], partial=True, params=cfg.dedupe, version=DEDUPE_VERSION)
+def dedupe(*source_records):
+    return deduplicate(itertools.chain(*(records for records in source_records if records is not None)))
+
+# criteria a database could not filter on are checked on the merged records
+@pipeline.stage(inputs=['dedupe'], params={'criteria': criteria}, version=SELECTION_CRITERIA_VERSION)
+def select(clusters):
+    selected = [cluster for cluster in clusters if criteria.matches(cluster.record)]
+    logger.info(f'Selected {len(selected)} of {len(clusters)} records on the inclusion criteria')
+    return selected
+
+# the combined database is always rewritten, it may have been changed since the last run
+@pipeline.stage(inputs=['select'], checkpoint=False)
+def export(combined_records):
+    return store_deduplicated_records(combined_db, combined_records)
+
+# failed branches are logged and skipped, the other branches still finish before the run fails
+pipeline.run()
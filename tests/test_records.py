@@ -0,0 +1,33 @@
+import datetime
+import arxiv
+import pandas as pd
+from types import MappingProxyType
+from utils.acm import ACM_Item
+from utils.arxiv import build_result_extractors, iter_arxiv_records
+from utils.dedupe import load_stored_records
+from utils.records import to_records
+from utils.storage import get_engine, store_records_in_sqlite
+from config.cfg import arxiv as arxiv_cfg
+
+
+def test_stored_acm_row_round_trips_to_record(tmp_path):
+    db_name = str(tmp_path / 'acm.db')
+    item = ACM_Item(doi='10.1145/1', title='A title', authors=['Smith, John', 'Ann Lee'], keywords=['thin film', 'coating'])
+    store_records_in_sqlite(db_name, 'search_results', [item], id_column='doi')
+    df = pd.read_sql('select * from search_results', get_engine(db_name))
+    record = next(to_records('acm', df))
+    assert record.author == ('Smith, John', 'Ann Lee')
+    assert record.keywords == ('thin film', 'coating')
+
+def test_stored_arxiv_row_round_trips_to_record(tmp_path):
+    db_name = str(tmp_path / 'arxiv.db')
+    result = arxiv.Result(
+        entry_id='http://arxiv.org/abs/2101.00001v1', title='A title', summary='An abstract',
+        authors=[arxiv.Result.Author('John Smith'), arxiv.Result.Author('Ann Lee')], categories=['cs.LG'],
+        published=datetime.datetime(2021, 1, 1), updated=datetime.datetime(2021, 1, 1), links=[]
+    )
+    extractors = build_result_extractors(arxiv_cfg['field_mapping']['search_results'], MappingProxyType({'cs.LG': 'Computer Science - Machine Learning'}))
+    store_records_in_sqlite(db_name, 'search_results', iter_arxiv_records([result], extractors), id_column='url')
+    record = next(load_stored_records(db_name, 'search_results', 'arxiv', kind=None))
+    assert record.author == ('John Smith', 'Ann Lee')
+    assert record.subject_areas == ('Computer Science - Machine Learning',)
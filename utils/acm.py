@@ -1,6 +1,12 @@
+import hashlib
 import urllib.parse
 import logging
-from dataclasses import dataclass
+import math
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import lxml.html
+from lxml.cssselect import CSSSelector
+from dataclasses import asdict, dataclass
 from typing import List
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -9,6 +15,10 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
 
 from utils.utils import setup_logger
+from utils.query import compile_query
+from utils.browser import BrowserPool
+from utils.storage import get_engine, quote, SQLiteRecordWriter
+from config.cfg import acm as cfg
 
 
 @dataclass
@@ -44,22 +54,112 @@ class ACM_Item:
 
 logger = setup_logger('acm', r'.\\logs\\acm.log', level=logging.INFO)
 
-def build_acm_search_url(query):
-    title_query = f'Title:({query})'
-    abstract_query = f'Abstract:({query})'
-    keyword_query = f'Keyword:({query})'
-    query = ' OR '.join([title_query, abstract_query, keyword_query])
+ACM_CONNECTOR_VERSION = 3
+
+def build_acm_search_url(query, criteria=None):
+    # Title:(...) OR Abstract:(...) OR Keyword:(...) with NOT for negations
+    query = compile_query(query, 'acm')
     query = urllib.parse.quote(query)
     query = query.replace('%20', '+')
     query = f'https://dl.acm.org/action/doSearch?fillQuickSearch=false&target=advanced&AllField={query}&expand=all&startPage=0&pageSize=50'
+    if criteria and criteria.years:
+        # publication years of the inclusion criteria, other criteria are checked locally
+        year_low, year_high = criteria.years
+        if criteria.year_low is not None:
+            query += f'&AfterMonth=1&AfterYear={year_low}'
+        query += f'&BeforeMonth=12&BeforeYear={year_high}'
     return query
 
-def scrape_acm_search_results(url, search_results_list, driver=None):
-    if not driver:
-        driver = webdriver.Firefox()
+def open_acm_browser_pool():
+    # cookies are declined once per browser session
+    def prepare_session(driver):
+        driver.get(cfg['base_url'])
+        decline_cookies(driver)
+    return BrowserPool(**cfg['browser_pool'], on_create=prepare_session)
+
+def build_acm_page_url(url, start_page):
+    parts = urllib.parse.urlsplit(url)
+    params = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if k != 'startPage']
+    params.append(('startPage', str(start_page)))
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(params)))
+
+def get_acm_page_size(url):
+    params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+    return int(params.get('pageSize', 20))
+
+def get_acm_checkpoint_table(url):
+    # one table per search url, items finished for another search string or other criteria are neither skipped nor returned
+    return f"{cfg['checkpoint_table']}_{hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]}"
+
+def acm_table_exists(connection, table_name):
+    return connection.exec_driver_sql('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', ('table', table_name)).fetchone() is not None
+
+def load_finished_acm_dois(db_name, table_name):
+    engine = get_engine(db_name)
+    with engine.connect() as connection:
+        if not acm_table_exists(connection, table_name):
+            return set()
+        # items stored with the fields of the result page only are not finished, rows of older tables without a status are
+        columns = [row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info({quote(table_name)})')]
+        condition = " AND (scrape_status IS NULL OR scrape_status = 'done')" if 'scrape_status' in columns else ''
+        return {row[0] for row in connection.exec_driver_sql(f'SELECT doi FROM {quote(table_name)} WHERE doi IS NOT NULL' + condition)}
+
+def load_acm_items(db_name, table_name):
+    with get_engine(db_name).connect() as connection:
+        if not acm_table_exists(connection, table_name):
+            return pd.DataFrame()
+        return pd.read_sql(f'select * from {quote(table_name)}', connection)
+
+def scrape_acm_search_results(url, db_name, pool=None):
+    # all result page urls are derived from hitsLength and pageSize of the first page, pages and publication pages
+    # are scraped by parallel workers and every finished item is checkpointed, a restarted run skips finished dois
+    table_name = get_acm_checkpoint_table(url)
+    logger.info(f'Checkpointing items of {url} in table {table_name}')
+    own_pool = pool is None
+    if own_pool:
+        pool = open_acm_browser_pool()
+    try:
+        first_page_url = build_acm_page_url(url, 0)
+        with pool.browser() as driver:
+            page_items, hits, _ = scrape_acm_search_page(driver, first_page_url)
+        page_size = get_acm_page_size(url)
+        page_urls = [build_acm_page_url(url, page) for page in range(1, math.ceil(hits / page_size))]
+        logger.info(f'Found {hits} hits on {len(page_urls) + 1} pages')
+        for page_url, page in zip(page_urls, pool.map(scrape_acm_search_page, page_urls)):
+            if page is None:
+                logger.error(f'Giving up on result page {page_url}')
+                continue
+            page_items.extend(page[0])
+        finished = load_finished_acm_dois(db_name, table_name)
+        pending = [(acm_item, pub_link) for acm_item, pub_link in page_items if acm_item.doi not in finished]
+        logger.info(f'Collected {len(page_items)}/{hits} hits, {len(page_items) - len(pending)} already finished')
+        with SQLiteRecordWriter(db_name, table_name, id_column='doi', batch_size=1) as checkpoint, \
+                ThreadPoolExecutor(max_workers=pool.size) as executor:
+            futures = {executor.submit(pool.run, lambda driver, entry: open_publication_page(driver, *entry), entry): entry for entry in pending}
+            for i, future in enumerate(as_completed(futures), 1):
+                acm_item, _ = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    # the item is stored with the fields of the result page and retried on the next run
+                    logger.error(f'Error opening publication page of {acm_item.doi}: {e}')
+                    checkpoint.write({**asdict(acm_item), 'scrape_status': 'result_page'})
+                    continue
+                if acm_item.doi is None:
+                    logger.warning(f'Item without doi cannot be skipped on a restart: {acm_item.title}')
+                checkpoint.write({**asdict(acm_item), 'scrape_status': 'done'})
+                logger.info(f'Finished item {i}/{len(pending)}: {acm_item.title}')
+    finally:
+        if own_pool:
+            pool.close()
+    return load_acm_items(db_name, table_name)
+
+def scrape_acm_search_page(driver, url):
+    # returns the (acm_item, publication link) pairs of a result page, the hits length and the next page url
     driver.get(url)
-    # reject cookies
-    decline_cookies(driver)
+    if cfg['extraction_mode'] == 'local':
+        return parse_acm_search_page_source(driver.page_source, driver.current_url)
+    page_items = []
     # get hitslength
     try:
         hits = driver.find_element(By.CLASS_NAME, 'hitsLength').text
@@ -151,26 +251,21 @@ def scrape_acm_search_results(url, search_results_list, driver=None):
             acm_item.keywords = keywords_list
         except Exception as e:
             logger.error(f'Error getting keywords: {e}')
-        # open publication in new window and add information to acm_item
-        open_publication_page(result, acm_item)
-        # add acm_item to list
-        search_results_list.append(acm_item)
-        logger.info(f'Finished item: {acm_item.title}')
+        # publication page is opened later on a pooled browser
+        try:
+            pub_link = result.find_element(By.CLASS_NAME, 'issue-item__title').find_element(By.TAG_NAME, 'a').get_attribute('href')
+        except Exception as e:
+            pub_link = None
+            logger.error(f'Error getting publication link: {e}')
+        page_items.append((acm_item, pub_link))
         print(f'Finished item: {acm_item.title}')
-    
-    logger.info(f'Finished page: {len(search_results_list)}/{hits} hits')
-    print(f'Finished page: {len(search_results_list)}/{hits} hits')
+
     try:
         next_page_url = driver.find_element(By.CLASS_NAME, 'pagination').find_element(By.CLASS_NAME, 'pagination__btn--next').get_attribute('href')
     except Exception as e:
         next_page_url = None
         logger.error(f'Error getting next page url: {e}')
-        if len(search_results_list) < hits:
-            logger.error(f'Not all hits were processed: {len(search_results_list)}/{hits}')
-        else:
-            logger.info('All hits were processed')
-    if next_page_url:
-        scrape_acm_search_results(next_page_url, search_results_list, driver)
+    return page_items, hits, next_page_url
 
 def decline_cookies(driver):
     # decline all cookies
@@ -181,17 +276,26 @@ def decline_cookies(driver):
         logger.error(f'Error declining cookies: {e}')
 
 
-def open_publication_page(result_box, item: ACM_Item):
-    # get url, open and decline cookies
-    try:
-        pub_link = result_box.find_element(By.CLASS_NAME, 'issue-item__title').find_element(By.TAG_NAME, 'a').get_attribute('href')
-        driver = webdriver.Firefox()
-        driver.get(pub_link)
-        # reject cookies
-        decline_cookies(driver)
-    except Exception as e:
-        logger.error(f'Error getting publication link: {e}')
-        return
+def open_publication_page(driver, item: ACM_Item, pub_link):
+    # open publication page in the tab of the pooled browser
+    if not pub_link:
+        return item
+    driver.get(pub_link)
+    if cfg['extraction_mode'] == 'local':
+        citedby_url = parse_publication_page_source(driver.page_source, item, driver.current_url)
+    else:
+        citedby_url = read_publication_page(driver, item)
+    # get citations (same tab)
+    if citedby_url and not citedby_url.endswith('#'):
+        try:
+            item.cited_by = open_cited_by_page(driver, citedby_url, item.publication_type)
+        except Exception as e:
+            logger.error(f'Error getting cited by: {e}')
+    return item
+
+def read_publication_page(driver, item: ACM_Item):
+    # reads the fields of the open publication page through the webdriver and returns the cited by url
+    pub_link = driver.current_url
     # if item.publication_type == 'ARTICLE' or item.publication_type == 'RESEARCH-ARTICLE':
     # get abstract
     try:
@@ -227,14 +331,12 @@ def open_publication_page(result_box, item: ACM_Item):
         item.references = references_list
     except Exception as e:
         logger.error(f'Error getting references: {e}')
-    # get citations (open in new window)
+    # get citations url, the page is opened after everything else was read from the publication page
     try:
         cited_by_section = driver.find_element(By.CSS_SELECTOR, 'div.article__cited.article__section')
         citedby_url = cited_by_section.find_element(By.ID, 'downloadAllMain').get_attribute('href')
-        if not citedby_url.endswith('#'):
-            cited_by_list = open_cited_by_page(citedby_url, item.publication_type)
-            item.cited_by = cited_by_list
     except Exception as e:
+        citedby_url = None
         logger.error(f'Error getting cited by: {e}')
     # get author tags (open side bar)
     try:
@@ -300,22 +402,19 @@ def open_publication_page(result_box, item: ACM_Item):
     # TODO add more publication types
     if not pub_link:
         None
-    driver.close()
+    return citedby_url
         
 
-def open_cited_by_page(url, pub_type):
-    driver = webdriver.Firefox()
+def open_cited_by_page(driver, url, pub_type):
     driver.get(url)
-    # reject cookies
-    decline_cookies(driver)
+    if cfg['extraction_mode'] == 'local':
+        return parse_cited_by_page_source(driver.page_source, pub_type)
     ref_items = driver.find_elements(By.CLASS_NAME, 'references__item')
     ref_item_list = []
     if isinstance(ref_items, webdriver.remote.webelement.WebElement):
         ref_items = [ref_items]
     for ref_item in ref_items:
         ref_item_list.append(parse_reference_item(ref_item, pub_type))   
-    # close
-    driver.close()
     return ref_item_list
 
 def parse_authors_from_text(ref_item):
@@ -423,14 +522,144 @@ def parse_reference_item(ref_item, pub_type):
 
     return result
 
+# Local extraction: the rendered page source is read once and parsed with lxml.
+# Selectors are compiled once; a missing field is an empty match instead of a webdriver timeout.
+SELECTORS = {name: CSSSelector(selector) for name, selector in {
+    # search result page
+    'hits': '.hitsLength',
+    'search_item': '.search-result__xsl-body .search__item',
+    'doi': '.issue-Item__checkbox',
+    'publication_type': '.issue-heading',
+    'date': '.bookPubDate',
+    'title': '.issue-item__title',
+    'title_link': '.issue-item__title a',
+    'authors': '.rlist--inline .hlFld-ContribAuthor a',
+    'publication': '.issue-item__detail',
+    'publication_link': '.issue-item__detail a',
+    'abstract': '.abstract-text p',
+    'subjects': '.Subject p',
+    'keywords': '.keywords-text p',
+    'next_page': '.pagination .pagination__btn--next',
+    # publication page
+    'publication_abstract': '.abstractSection p',
+    'affiliation': '.published-info .rlist--inline',
+    'index_terms': 'ol.rlist.organizational-chart a',
+    'references': 'div.article__section.article__references ol.rlist.references__list li',
+    'cited_by_url': 'div.article__cited.article__section #downloadAllMain',
+    'author_tags': '.tags-widget li .badge-type',
+    # cited by page and reference items
+    'cited_by_items': '.references__item',
+    'reference_names': '.references__authors .references__name',
+    'reference_authors': '.references__authors',
+    'reference_year': '.references__year',
+    'pub_year': '.pub-year',
+    'reference_title': '.references__article-title',
+    'reference_source': '.references__source',
+    'reference_volume': '.references__volume',
+    'volume': '.volume',
+    'reference_issue': '.references__issue',
+    'issue': '.issue',
+    'pub_date': '.pub-date',
+    'reference_doi': 'span.doi',
+    'link': '.link',
+    'reference_note': '.references__note',
+}.items()}
+
+def element_text(element):
+    return ' '.join(element.text_content().split())
+
+def select_texts(element, name):
+    return [text for text in (element_text(match) for match in SELECTORS[name](element)) if text]
+
+def select_text(element, name):
+    texts = select_texts(element, name)
+    return texts[0] if texts else None
+
+def select_attribute(element, name, attribute):
+    for match in SELECTORS[name](element):
+        value = match.get(attribute)
+        if value:
+            return value
+    return None
+
+def unique(values):
+    return list(dict.fromkeys(values))
+
+def parse_acm_search_page_source(html, url):
+    # same result as the webdriver extraction of scrape_acm_search_page
+    document = lxml.html.fromstring(html, base_url=url)
+    document.make_links_absolute(url)
+    hits = select_text(document, 'hits')
+    hits = int(hits.replace(',', '')) if hits and hits.replace(',', '').isdigit() else 0
+    page_items = []
+    for result in SELECTORS['search_item'](document):
+        acm_item = ACM_Item()
+        acm_item.doi = select_attribute(result, 'doi', 'name')
+        acm_item.publication_type = select_text(result, 'publication_type')
+        acm_item.date = select_attribute(result, 'date', 'data-title')
+        acm_item.title = select_text(result, 'title')
+        acm_item.authors = unique(match.get('title') for match in SELECTORS['authors'](result) if match.get('title'))
+        acm_item.publication = select_text(result, 'publication')
+        acm_item.publication_short = select_attribute(result, 'publication_link', 'title')
+        abstract = select_texts(result, 'abstract')
+        acm_item.abstract = ' '.join(abstract) if abstract else None
+        acm_item.subjects = unique(select_texts(result, 'subjects')) or None
+        acm_item.keywords = unique(select_texts(result, 'keywords')) or None
+        page_items.append((acm_item, select_attribute(result, 'title_link', 'href')))
+        if acm_item.doi is None or acm_item.title is None:
+            logger.error(f'Incomplete search result: doi {acm_item.doi}, title {acm_item.title}')
+    next_page_url = select_attribute(document, 'next_page', 'href')
+    return page_items, hits, next_page_url
+
+def parse_publication_page_source(html, item: ACM_Item, url):
+    # same fields as read_publication_page, returns the cited by url
+    document = lxml.html.fromstring(html, base_url=url)
+    document.make_links_absolute(url)
+    abstract = select_text(document, 'publication_abstract')
+    if abstract and (item.abstract is None or (item.abstract != abstract and len(abstract) >= len(item.abstract))):
+        item.abstract = abstract
+    item.affiliation = select_text(document, 'affiliation') or item.affiliation
+    item.index_terms = select_texts(document, 'index_terms') or item.index_terms
+    # hidden references are part of the page source, no need to click 'show all'
+    references = SELECTORS['references'](document)
+    if references:
+        item.references = [parse_reference_element(ref, item.publication_type) for ref in references]
+    author_tags = [match.get('title') for match in SELECTORS['author_tags'](document) if match.get('title')]
+    item.author_tags = author_tags or item.author_tags
+    return select_attribute(document, 'cited_by_url', 'href')
+
+def parse_cited_by_page_source(html, pub_type):
+    document = lxml.html.fromstring(html)
+    return [parse_reference_element(ref_item, pub_type) for ref_item in SELECTORS['cited_by_items'](document)]
+
+def parse_reference_element(ref_item, pub_type):
+    # lxml counterpart of parse_reference_item
+    result = Reference_Item()
+    result.authors = select_texts(ref_item, 'reference_names')
+    if not result.authors:
+        authors = select_text(ref_item, 'reference_authors')
+        result.authors = [author.strip() for author in authors.replace(' and ', ',').split(',')] if authors else []
+    year = select_text(ref_item, 'reference_year') or select_text(ref_item, 'pub_year')
+    result.year = year.strip('().') if year else None
+    result.title = select_text(ref_item, 'reference_title')
+    result.publication = select_text(ref_item, 'reference_source')
+    result.volume = select_text(ref_item, 'reference_volume') or select_text(ref_item, 'volume')
+    result.issue = select_text(ref_item, 'reference_issue') or select_text(ref_item, 'issue')
+    pub_date = select_text(ref_item, 'pub_date')
+    if pub_date and ':' in pub_date:
+        result.pub_date = pub_date.split(':')[1].strip(' ')
+    doi = select_text(ref_item, 'reference_doi') or select_attribute(ref_item, 'link', 'href')
+    if doi and 'doi.org' in doi:
+        doi = doi.split('doi.org/')[1]
+    result.doi = doi
+    result.note = select_text(ref_item, 'reference_note')
+    return result
+
 # TODO CONTINUE HERE
 # template from copilot
-def open_acm_publication(doi):
-    url = f'https://dl.acm.org/doi/{doi}'
-    driver = webdriver.Firefox()
+def open_acm_publication(driver, doi):
+    url = f"{cfg['base_url']}/doi/{doi}"
     driver.get(url)
-    # reject cookies
-    decline_cookies(driver)
     # check if we are redirected to a different page
     if 'doi' not in driver.current_url:
         # we are redirected
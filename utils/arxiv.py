@@ -1,128 +1,186 @@
 import arxiv
+import datetime
+import functools
+import hashlib
+import itertools
+import operator
 import urllib.parse
 import logging
+import lxml.html
 import pandas as pd
-import os
-from sqlalchemy import create_engine
-from sqlalchemy.engine import reflection
+import requests
+from lxml.cssselect import CSSSelector
+from types import MappingProxyType
 from utils.utils import setup_logger
+from utils.query import compile_query
+from utils.storage import DEFAULT_BATCH_SIZE, get_engine, quote, store_records_in_sqlite, SQLiteRecordWriter
 from config.cfg import arxiv as cfg
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.wait import WebDriverWait
 
 logger = setup_logger('arxiv', r'.\\logs\\arxiv.log', level=logging.INFO)
 
+TAXONOMY_CATEGORY_ROWS = CSSSelector('div.columns.divided')
+TAXONOMY_COLUMNS = CSSSelector('div.column')
+ARXIV_CONNECTOR_VERSION = 3
 
-def build_arxiv_query(query):
+
+def build_arxiv_query(query, criteria=None):
     # `au:del_maestro AND ti:checkerboard`, not
     # `au:del_maestro+AND+ti:checkerboard`.
-    query = query.replace('-', 'NOT ')
-    query = query.replace('AND NOT', 'ANDNOT')
-    if 'OR NOT' in query:
-        logger.error('OR NOT not supported by arxiv API. Please use ANDNOT instead.')
-    query = query.replace('(', 'all:(')
-    # query = urllib.parse.quote(query)
-    # query = query.replace('%20', '+')
-    # query = query.replace('%28', 'all:%28')	
+    # every term gets the all: prefix, negations become ANDNOT and '?' spellings are expanded
+    query = compile_query(query, 'arxiv')
+    if criteria and criteria.years:
+        # submission dates of the inclusion criteria, other criteria are checked locally
+        year_low, year_high = criteria.years
+        query = f'({query}) AND submittedDate:[{year_low or 1991}01010000 TO {year_high}12312359]'
     return query
 
 def search_arxiv(client, arxiv_query):
     # Create arxiv search
     search = arxiv.Search(
         query = arxiv_query,
+        max_results = None,
         sort_by = arxiv.SortCriterion.SubmittedDate
     )
-    # exhaust results into a list
-    results_arxiv = list(client.results(search))
-    return results_arxiv
+    # results are fetched page by page while the generator is consumed
+    return client.results(search)
+
+def load_harvest_offset(db_name, harvest_table):
+    # the query column holds the harvest table of a query
+    engine = get_engine(db_name)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f'CREATE TABLE IF NOT EXISTS {quote(cfg["harvest"]["progress_table"])} (query TEXT PRIMARY KEY, "offset" INTEGER, finished INTEGER, updated_at TEXT)')
+        row = connection.exec_driver_sql(f'SELECT "offset", finished FROM {quote(cfg["harvest"]["progress_table"])} WHERE query = ?', (harvest_table,)).fetchone()
+    return (row[0], bool(row[1])) if row else (0, False)
+
+def save_harvest_offset(db_name, harvest_table, offset, finished=False):
+    with get_engine(db_name).begin() as connection:
+        connection.exec_driver_sql(
+            f'INSERT OR REPLACE INTO {quote(cfg["harvest"]["progress_table"])} (query, "offset", finished, updated_at) VALUES (?, ?, ?, ?)',
+            (harvest_table, offset, int(finished), datetime.datetime.now().isoformat())
+        )
+
+def get_arxiv_harvest_table(table_name, arxiv_query):
+    # one table per query, results harvested for other search strings or criteria are not loaded with its results
+    # the connector version is part of the name, rows stored in an older layout are harvested again
+    key = f'{ARXIV_CONNECTOR_VERSION}:{arxiv_query}'
+    return f"{table_name}_{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}"
+
+def harvest_arxiv(db_name, table_name, arxiv_query, category_taxonomy, max_results=None):
+    # Streams the results of arxiv_query into its table (see get_arxiv_harvest_table) page by page. The offset after every
+    # stored page is recorded, so a broken connection resumes mid-stream on the next call instead of starting over.
+    # Results are sorted by ascending submission date so new submissions do not shift the offsets of a resumed harvest,
+    # a finished harvest continues from its offset with the submissions that came in since.
+    settings = cfg['harvest']
+    table_name = get_arxiv_harvest_table(table_name, arxiv_query)
+    # progress is kept per table, a new table starts at offset 0
+    offset, finished = load_harvest_offset(db_name, table_name)
+    if finished:
+        logger.info(f'Harvest of {arxiv_query} finished with {offset} results before, fetching new submissions')
+    client = arxiv.Client(page_size=settings['page_size'], delay_seconds=settings['delay_seconds'], num_retries=settings['num_retries'])
+    search = arxiv.Search(
+        query = arxiv_query,
+        max_results = max_results,
+        sort_by = arxiv.SortCriterion.SubmittedDate,
+        sort_order = arxiv.SortOrder.Ascending
+    )
+    extractors = build_result_extractors(cfg['field_mapping']['search_results'], get_category_labels(category_taxonomy))
+    results = client.results(search, offset=offset)
+    logger.info(f'Harvesting {arxiv_query} from offset {offset}')
+    # rows are upserted on the entry url, a page fetched again after a failure is not stored twice
+    with SQLiteRecordWriter(db_name, table_name, id_column='url', batch_size=settings['page_size']) as writer:
+        while True:
+            page = list(itertools.islice(results, settings['page_size']))
+            if not page:
+                break
+            writer.write_many(iter_arxiv_records(page, extractors))
+            writer.flush()
+            offset += len(page)
+            save_harvest_offset(db_name, table_name, offset)
+            logger.info(f'Stored arxiv results up to offset {offset}')
+    save_harvest_offset(db_name, table_name, offset, finished=True)
+    logger.info(f'Finished harvest of {arxiv_query} with {offset} results, totals: {writer.counts}')
+    return offset
+
+def get_category_labels(taxonomy):
+    # frozen category id -> 'group - category' mapping, built once per taxonomy instead of scanning it per lookup
+    if isinstance(taxonomy, MappingProxyType):
+        return taxonomy
+    if taxonomy is None:
+        return get_arxiv_category_labels()
+    return MappingProxyType({
+        category_id: f'{group_name} - {category_name}'
+        for category_id, group_name, category_name in zip(taxonomy['category_id'], taxonomy['group_name'], taxonomy['category_name'])
+    })
 
-# Store scopus results in sqlite
+def build_result_extractors(field_mapping, category_labels):
+    # one extractor per column, resolved once instead of per result
+    def extractor(field):
+        if field == 'openaccess':
+            return lambda result: True
+        get_value = operator.attrgetter(field)
+        # lists are stored as json arrays, names and labels can contain commas themselves
+        if field == 'categories':
+            return lambda result: [category_labels[category] for category in get_value(result) if category in category_labels]
+        if field == 'authors':
+            return lambda result: [author.name for author in get_value(result)]
+        return get_value
+    return [(column, extractor(field)) for column, field in field_mapping.items()]
+
+def extract_arxiv_columns(results, extractors):
+    # one pass per column over a batch of results
+    return {column: [extract(result) for result in results] for column, extract in extractors}
+
+def iter_arxiv_records(arxiv_results, extractors, batch_size=DEFAULT_BATCH_SIZE):
+    arxiv_results = iter(arxiv_results)
+    while True:
+        batch = list(itertools.islice(arxiv_results, batch_size))
+        if not batch:
+            return
+        columns = extract_arxiv_columns(batch, extractors)
+        for values in zip(*columns.values()):
+            yield dict(zip(columns, values))
+
+# Store arxiv results in sqlite
 def store_arxiv_results_in_sqlite(db_name, table_name, arxiv_results, category_taxonomy, mode='replace', id_column=None):
-    columns = list(cfg['field_mapping']['search_results'].keys())
-    tuple_list = []
-    for result in arxiv_results:
-        tuple_list.append(tuple([get_result_column(result, column, category_taxonomy) for column in cfg['field_mapping']['search_results'].values()]))
-    
-    # Convert the results to pandas dataframe
-    results = pd.DataFrame(tuple_list, columns=columns)
-    # Create a SQLAlchemy engine
-    engine = create_engine(f'sqlite:///{db_name}')
-    # Store the DataFrame in the SQLite database
-    if mode == 'replace':
-        results.to_sql(table_name, engine, if_exists='replace', index=False)
-    elif mode == 'update':
-        insp = reflection.Inspector.from_engine(engine)
-        if table_name in insp.get_table_names():
-            existing_df = pd.read_sql(f'select * from "{table_name}"', engine)
-            results = pd.concat([existing_df, results], axis=0).drop_duplicates(subset=id_column, keep=False)
-        results.to_sql(table_name, engine, if_exists='append', index=False)
-    else:
-        raise NotImplementedError(f'Mode {mode} not implemented')
-    return results
-
-def get_result_column(result, column, taxonomy=None):
-    if column == 'openaccess':
-        return True
-    value = getattr(result, column)
-    if column == 'categories':
-        categories = []
-        for category in value:
-            if category in taxonomy['category_id'].values:
-                cat_row = taxonomy[taxonomy['category_id'] == category].iloc[0]
-                cat_str = f"{cat_row['group_name']} - {cat_row['category_name']}"
-                categories.append(cat_str)
-        return ', '.join(categories)
-    if isinstance(value, list) and len(value) > 0 and isinstance(value[0], arxiv.Result.Author):
-        return ', '.join([author.name for author in value])
-    return value
-
-def load_arxiv_category_taxonomy_db():
-    db_name = cfg['category_taxonomy']['db_name']
-    # check if db exists
-    if not os.path.exists(db_name):
-        return build_arxiv_category_taxonomy_db()
-    # Create a SQLAlchemy engine
-    engine = create_engine(f'sqlite:///{db_name}')
-    # Create a table with the category taxonomy
-    df = pd.read_sql('select * from category_taxonomy', engine)
-    return df
+    # results are converted batch by batch so arxiv_results can be a generator
+    extractors = build_result_extractors(cfg['field_mapping']['search_results'], get_category_labels(category_taxonomy))
+    records = iter_arxiv_records(arxiv_results, extractors)
+    return store_records_in_sqlite(db_name, table_name, records, mode=mode, id_column=id_column)
 
-def build_arxiv_category_taxonomy_db():
-    db_name = cfg['category_taxonomy']['db_name']
-    table_name = cfg['category_taxonomy']['table_name']
-    # group tuple list
+@functools.lru_cache(maxsize=None)
+def load_arxiv_category_taxonomy():
+    # read once per process from the bundled file, the first line holds the version
+    return pd.read_csv(cfg['category_taxonomy']['file'], comment='#', dtype=str)
+
+@functools.lru_cache(maxsize=None)
+def get_arxiv_category_labels():
+    return get_category_labels(load_arxiv_category_taxonomy())
+
+def parse_arxiv_category_taxonomy(html):
+    # groups are accordion heads, each followed by a body with one row per category: 'cs.AI (Artificial Intelligence)'
+    document = lxml.html.fromstring(html)
     group_list = []
-    # Scrape taxonomy from web
-    url = 'https://arxiv.org/category_taxonomy'
-    driver = webdriver.Firefox()
-    driver.get(url)
-    # get category taxonomly list
-    category_taxonomy_root = driver.find_element(By.ID, 'category_taxonomy_list')
-    # get groups
-    groups = category_taxonomy_root.find_elements(By.CLASS_NAME, 'accordion-head')
-    category_bodies = category_taxonomy_root.find_elements(By.CLASS_NAME, 'accordion-body')
-    for i, group in enumerate(groups):
-        group_name = group.text
-        # click on group to make text visible
-        WebDriverWait(group, 10).until(EC.element_to_be_clickable(group))
-        group.click()
-        # get categories
-        # category_root = category_bodies[i].find_element(By.CSS_SELECTOR, 'div.accordion-body.open')
-        categories = category_bodies[i].find_elements(By.CSS_SELECTOR, 'div.columns.divided')
-        for category in categories:
-            columns = category.find_elements(By.CSS_SELECTOR, 'div.column')
-            category_text = columns[0].text
+    root = document.get_element_by_id('category_taxonomy_list')
+    for group, body in zip(root.find_class('accordion-head'), root.find_class('accordion-body')):
+        group_name = ' '.join(group.text_content().split())
+        for category in TAXONOMY_CATEGORY_ROWS(body):
+            category_text = ' '.join(TAXONOMY_COLUMNS(category)[0].text_content().split())
             category_id = category_text.split('(')[0].strip()
             category_name = category_text.split('(')[1].replace(')', '')
-            category_description = columns[1].text
-            group_list.append((category_id, group_name, category_name, category_description))
-    driver.quit()     
-    # Create a SQLAlchemy engine
-    engine = create_engine(f'sqlite:///{db_name}')
-    # Create a table with the category taxonomy
-    df = pd.DataFrame(group_list, columns=['category_id', 'group_name', 'category_name', 'category_description'])
-    df.to_sql(table_name, engine, if_exists='replace', index=False)
-    return df
\ No newline at end of file
+            group_list.append((category_id, group_name, category_name))
+    return pd.DataFrame(group_list, columns=['category_id', 'group_name', 'category_name'])
+
+def refresh_arxiv_category_taxonomy():
+    # explicit update of the bundled taxonomy file from arxiv.org, not needed for a normal run
+    response = requests.get(cfg['category_taxonomy']['url'], timeout=30)
+    response.raise_for_status()
+    df = parse_arxiv_category_taxonomy(response.text)
+    if df.empty:
+        raise ValueError('No categories found, the layout of the taxonomy page may have changed')
+    with open(cfg['category_taxonomy']['file'], 'w', encoding='utf-8', newline='') as f:
+        f.write(f"# arxiv category taxonomy from {cfg['category_taxonomy']['url']}, version {datetime.date.today().isoformat()}\n")
+        df.to_csv(f, index=False, lineterminator='\n')
+    load_arxiv_category_taxonomy.cache_clear()
+    get_arxiv_category_labels.cache_clear()
+    logger.info(f'Refreshed arxiv category taxonomy with {len(df)} categories')
+    return df
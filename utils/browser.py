@@ -0,0 +1,161 @@
+import contextlib
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from utils.utils import setup_logger
+
+logger = setup_logger('browser', r'.\\logs\\browser.log', level=logging.INFO)
+
+# placeholder in the idle queue for a session that is yet to be created
+EMPTY_SLOT = object()
+
+
+class BrowserPool:
+    # Keeps up to size browser sessions alive and lends them out one at a time.
+    # A session keeps its first tab and is reused for the next page; sessions that fail a health check
+    # or have loaded max_uses pages are quit and replaced by a new one on demand.
+    # The idle queue starts with size empty slots, a discarded session puts its slot back, so a thread
+    # waiting for a session is woken up to create one.
+    # on_create runs once per new session, e.g. to decline cookie banners for the whole session.
+    def __init__(self, size=4, headless=True, max_uses=100, page_load_timeout=30, on_create=None):
+        self.size = size
+        self.headless = headless
+        self.max_uses = max_uses
+        self.page_load_timeout = page_load_timeout
+        self.on_create = on_create
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(EMPTY_SLOT)
+        self._uses = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _create(self):
+        options = webdriver.FirefoxOptions()
+        if self.headless:
+            options.add_argument('-headless')
+        driver = webdriver.Firefox(options=options)
+        driver.set_page_load_timeout(self.page_load_timeout)
+        with self._lock:
+            self._uses[driver] = 0
+            logger.info(f'Started browser session ({len(self._uses)}/{self.size})')
+        if self.on_create:
+            try:
+                self.on_create(driver)
+            except WebDriverException as e:
+                logger.error(f'Error preparing browser session: {e}')
+        return driver
+
+    def _acquire(self):
+        # an idle session, else an empty slot to create one in, else wait for a session or slot to come back
+        driver = self._idle.get()
+        if self._closed:
+            # passed on, so every waiting thread wakes up
+            self._idle.put(driver)
+            raise RuntimeError('Browser pool is closed')
+        if driver is not EMPTY_SLOT:
+            return driver
+        try:
+            return self._create()
+        except Exception:
+            self._idle.put(EMPTY_SLOT)
+            raise
+
+    def _discard(self, driver):
+        with self._lock:
+            self._uses.pop(driver, None)
+        try:
+            driver.quit()
+        except WebDriverException as e:
+            logger.error(f'Error quitting browser session: {e}')
+        self._idle.put(EMPTY_SLOT)
+
+    @staticmethod
+    def is_healthy(driver):
+        try:
+            handles = driver.window_handles
+            return len(handles) > 0
+        except WebDriverException:
+            return False
+
+    def _release(self, driver, failed=False):
+        self._uses[driver] = self._uses.get(driver, 0) + 1
+        if failed or self._closed or self._uses[driver] >= self.max_uses or not self.is_healthy(driver):
+            logger.info(f'Recycling browser session after {self._uses[driver]} uses')
+            self._discard(driver)
+            return
+        # tabs opened while the session was lent out are closed, the first tab is reused
+        try:
+            handles = driver.window_handles
+            for handle in handles[1:]:
+                driver.switch_to.window(handle)
+                driver.close()
+            driver.switch_to.window(handles[0])
+        except WebDriverException as e:
+            logger.error(f'Error resetting browser tabs: {e}')
+            self._discard(driver)
+            return
+        self._idle.put(driver)
+
+    @contextlib.contextmanager
+    def browser(self):
+        driver = self._acquire()
+        while not self.is_healthy(driver):
+            logger.warning('Replacing unhealthy browser session')
+            self._discard(driver)
+            driver = self._acquire()
+        failed = False
+        try:
+            yield driver
+        except WebDriverException:
+            # the session may be broken, it is replaced instead of being reused
+            failed = True
+            raise
+        finally:
+            self._release(driver, failed)
+
+    def run(self, f, item, retries=1):
+        # f(driver, item) on a pooled session, retried on a fresh session if the browser fails
+        for attempt in range(retries + 1):
+            try:
+                with self.browser() as driver:
+                    return f(driver, item)
+            except WebDriverException as e:
+                logger.error(f'Browser error (attempt {attempt + 1}/{retries + 1}): {e}')
+                if attempt == retries:
+                    raise
+
+    def map(self, f, items, retries=1):
+        # work queue fanning items out over the pool, results are returned in item order
+        # an item that keeps failing returns None instead of stopping the other items
+        def work(item):
+            try:
+                return self.run(f, item, retries)
+            except Exception as e:
+                logger.error(f'Giving up on item: {e}')
+                return None
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(work, items))
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if driver is not EMPTY_SLOT:
+                self._discard(driver)
+        # wakes the threads waiting for a session, they raise on the closed pool
+        self._idle.put(EMPTY_SLOT)
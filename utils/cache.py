@@ -0,0 +1,135 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from config.cfg import cache as cfg
+from utils.utils import setup_logger
+
+logger = setup_logger('cache', r'.\\logs\\cache.log', level=logging.INFO)
+
+# query parameters that identify the caller but not the requested content
+SECRET_PARAMETERS = {'api_key', 'apikey', 'apiKey', 'cltoken', 'mailto'}
+
+
+def normalize_url(url):
+    # drop api keys and sort parameters so equal requests share one cache entry
+    parts = urllib.parse.urlsplit(url)
+    params = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if k not in SECRET_PARAMETERS]
+    query = urllib.parse.urlencode(sorted(params))
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+def request_key(namespace, request):
+    if isinstance(request, str) and '://' in request:
+        request = normalize_url(request)
+    else:
+        request = json.dumps(request, sort_keys=True, default=str)
+    return hashlib.sha256(f'{namespace}\n{request}'.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, db_name, ttl, max_size):
+        self.db_name = db_name
+        self.ttl = ttl
+        self.max_size = max_size
+        if os.path.dirname(db_name):
+            os.makedirs(os.path.dirname(db_name), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_name, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, namespace TEXT, value TEXT, size INTEGER, created_at REAL, accessed_at REAL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self._connection.commit()
+        self._size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('SELECT value, size, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            value, size, created_at = row
+            if self.ttl is not None and created_at + self.ttl < now:
+                self._connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._connection.commit()
+                self._size -= size
+                return None
+            self._connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+            self._connection.commit()
+        return json.loads(value)
+
+    def set(self, key, value, namespace=None):
+        value = json.dumps(value)
+        size = len(value.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses (key, namespace, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, namespace, value, size, now, now)
+            )
+            self._size += size - (row[0] if row else 0)
+            if self._size > self.max_size:
+                self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        # least recently used entries go first until the cache is back to 90% of its size limit
+        target = 0.9 * self.max_size
+        evicted = []
+        for key, size in self._connection.execute('SELECT key, size FROM responses ORDER BY accessed_at'):
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+        logger.info(f'Evicted {len(evicted)} cached responses, {self._size} bytes left')
+
+    def clear(self, namespace=None):
+        with self._lock:
+            if namespace is None:
+                self._connection.execute('DELETE FROM responses')
+            else:
+                self._connection.execute('DELETE FROM responses WHERE namespace = ?', (namespace,))
+            self._connection.commit()
+            self._size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+
+@functools.lru_cache(maxsize=None)
+def get_response_cache():
+    return ResponseCache(cfg['db_name'], cfg['ttl'], cfg['max_size'])
+
+def lookup_cached_response(namespace, request):
+    # returns the cache key and the cached value, the value is None on a miss or if caching is off
+    if not cfg['enabled'] or request is None:
+        return None, None
+    cache_key = request_key(namespace, request)
+    return cache_key, get_response_cache().get(cache_key)
+
+def store_cached_response(namespace, cache_key, value):
+    if cache_key is not None and value is not None:
+        get_response_cache().set(cache_key, value, namespace)
+
+def cached_response(namespace, key=None):
+    # key maps the call arguments to the request identifying the response, default is the first argument (url)
+    # a key of None bypasses the cache for that call
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            request = key(*args, **kwargs) if key else args[0]
+            cache_key, value = lookup_cached_response(namespace, request)
+            if value is not None:
+                logger.info(f'Cache hit for {namespace} request')
+                return value
+            value = f(*args, **kwargs)
+            store_cached_response(namespace, cache_key, value)
+            return value
+        return wrapped
+    return decorator
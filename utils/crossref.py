@@ -1,6 +1,10 @@
 import logging
 import re
+import time
+import urllib.parse
+import requests
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from scholarly import scholarly
 from scholarly import ProxyGenerator
 from crossref.restful import Works
@@ -8,20 +12,38 @@ from sqlalchemy import create_engine
 from ratelimiter import RateLimiter
 from config import cfg
 from utils.utils import setup_logger
+from utils.cache import cached_response
+from utils.ratelimit import RequestLimiter
+from utils.records import normalize_doi, normalize_title
 
 logger = setup_logger('crossref', r'.\\logs\\crossref.log', level=logging.INFO)
 
+# one connection pool shared by the worker threads
+session = requests.Session()
+CROSSREF_CONNECTOR_VERSION = 3
 
-def fill_missing_values_using_crossref(works: Works, df, important_columns_dict):
+
+def fill_missing_values_using_crossref(df, important_columns_dict, doi_column='doi'):
     # identify rows with important missing values
     missing_values = df[df[list(important_columns_dict.values())].isnull().any(axis=1)]
     logger.info(f'Filling missing values using Crossref for {len(missing_values)} rows')
+    crossref_results = {}
+    # rows with a doi are resolved in batches of dois
+    if doi_column in missing_values.columns:
+        row_dois = {i: normalize_doi(doi) for i, doi in missing_values[doi_column].items()}
+        row_dois = {i: doi for i, doi in row_dois.items() if doi}
+        works_by_doi = lookup_crossref_dois(row_dois.values())
+        crossref_results = {i: works_by_doi[doi] for i, doi in row_dois.items() if doi in works_by_doi}
+        logger.info(f'Resolved {len(crossref_results)}/{len(row_dois)} rows by doi')
+    # the remaining rows are searched by title, author and year concurrently
+    remaining = missing_values[~missing_values.index.isin(list(crossref_results))]
+    crossref_results.update(query_crossref_bibliographic_concurrently(remaining))
     # iterate over rows and fill missing values
     for i, missing_values_row in missing_values.iterrows():
         title = missing_values_row['title']
         author = missing_values_row['author_names']
         year = missing_values_row['coverDate']
-        crossref_result = call_crossref(works, title, author, year)
+        crossref_result = crossref_results.get(i)
         if crossref_result is not None:
             logger.info(f'Crossref result found for {title} {author} {year}')
             for key in important_columns_dict.keys():
@@ -36,6 +58,83 @@ def fill_missing_values_using_crossref(works: Works, df, important_columns_dict)
             logger.warning(f'No crossref result found for {title} {author} {year}')
 
 
+def build_crossref_query(**params):
+    params['select'] = ','.join(cfg.crossref['select'])
+    if cfg.crossref['mailto']:
+        params['mailto'] = cfg.crossref['mailto']
+    return f"{cfg.crossref['api_url']}?{urllib.parse.urlencode(params)}"
+
+@cached_response('crossref_api')
+# one limiter shared by the worker threads
+@RequestLimiter(cfg.crossref['requests_per_second'])
+def get_crossref_results(url):
+    response = session.get(url, timeout=30)
+    if response.status_code != 200:
+        logger.error(f'Error {response.status_code} for {url}')
+        return None
+    return response.json()['message']
+
+def fetch_crossref_results(url):
+    for attempt in range(1, cfg.crossref['max_retries'] + 1):
+        try:
+            results = get_crossref_results(url)
+        except requests.RequestException as e:
+            logger.error(f'Request for {url} raised: {e}')
+            results = None
+        if results is not None:
+            return results
+        if attempt < cfg.crossref['max_retries']:
+            time.sleep(cfg.crossref['retry_delay'] * attempt)
+    return None
+
+def lookup_crossref_dois(dois):
+    # resolves many dois per request with filter=doi:a,doi:b and returns works by normalized doi
+    dois = list(dict.fromkeys(dois))
+    batch_size = cfg.crossref['doi_batch_size']
+    urls = [
+        build_crossref_query(filter=','.join(f'doi:{doi}' for doi in dois[i:i + batch_size]), rows=batch_size)
+        for i in range(0, len(dois), batch_size)
+    ]
+    works_by_doi = {}
+    with ThreadPoolExecutor(max_workers=cfg.crossref['max_workers']) as executor:
+        for results in executor.map(fetch_crossref_results, urls):
+            for item in (results or {}).get('items', []):
+                works_by_doi[normalize_doi(item.get('DOI'))] = item
+    logger.info(f'Crossref returned {len(works_by_doi)} works for {len(dois)} dois in {len(urls)} requests')
+    return works_by_doi
+
+def query_crossref_bibliographic(title, author, year):
+    if not isinstance(title, str):
+        return None
+    if isinstance(author, list):
+        author = ', '.join(author)
+    bibliographic = ' '.join(str(value) for value in (title, author, year) if not pd.isnull(value))
+    results = fetch_crossref_results(build_crossref_query(**{'query.bibliographic': bibliographic, 'rows': cfg.crossref['rows']}))
+    normalized_title = normalize_title(title)
+    for item in (results or {}).get('items', []):
+        if any(normalize_title(item_title) == normalized_title for item_title in item.get('title', [])):
+            return item
+    return None
+
+def query_crossref_bibliographic_concurrently(rows_df):
+    crossref_results = {}
+    with ThreadPoolExecutor(max_workers=cfg.crossref['max_workers']) as executor:
+        futures = {
+            executor.submit(query_crossref_bibliographic, row['title'], row['author_names'], row['coverDate']): i
+            for i, row in rows_df.iterrows()
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f'Crossref search for row {futures[future]} raised: {e}')
+                continue
+            if result is not None:
+                crossref_results[futures[future]] = result
+    logger.info(f'Crossref bibliographic search matched {len(crossref_results)}/{len(rows_df)} rows')
+    return crossref_results
+
+
 def get_crossref_value(field, crossref_result):
     unparsed_value = crossref_result[cfg.crossref['field_mapping']['search_results'][field]]
     match field:
@@ -54,6 +153,7 @@ def get_crossref_value(field, crossref_result):
         case _:
             return unparsed_value[0]
 
+@cached_response('crossref', key=lambda works, title, author, year: [title, author, year])
 @RateLimiter(max_calls=50, period=1)
 def call_crossref(works: Works, title, author, year):
     if isinstance(author, list):
@@ -0,0 +1,205 @@
+import logging
+import zlib
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from config.cfg import dedupe as cfg
+from utils.records import Record, RECORD_FIELDS, normalize_doi, normalize_title, record_key, record_year, to_records
+from utils.storage import get_engine, quote, store_records_in_sqlite
+from utils.utils import setup_logger
+
+logger = setup_logger('dedupe', r'.\\logs\\dedupe.log', level=logging.INFO)
+
+# Records of all sources are merged in two steps: records with the same normalized DOI are joined first,
+# then the remaining records are matched on their titles with MinHash signatures and locality sensitive hashing.
+# Only records sharing a band of their signature and a year block become candidates, so the work grows with the
+# number of records instead of the number of pairs. Candidates are confirmed on signature agreement, year and first author.
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+DEDUPE_VERSION = 2
+
+
+class MinHasher:
+    def __init__(self, num_perm=cfg['num_perm'], seed=cfg['seed']):
+        generator = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = generator.randint(1, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+        self.b = generator.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+    def signature(self, shingles):
+        # one row per shingle, the minimum of every permutation column is the signature
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        # array arithmetic wraps around on overflow like the usual uint64 minhash implementations
+        permuted = ((hashes[:, None] * self.a + self.b) % MERSENNE_PRIME) & MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            # the lower index stays root, so clusters keep the order the records came in
+            self.parent[max(i, j)] = min(i, j)
+
+
+class Cluster:
+    # canonical record of a group of duplicates and the source records it was merged from
+    __slots__ = ('record', 'members', 'cluster_id')
+
+    def __init__(self, record, members, cluster_id=None):
+        self.record = record
+        self.members = members
+        self.cluster_id = cluster_id or record_key(record)
+
+    @property
+    def provenance(self):
+        return [(member.source, member.identifier or member.doi or member.url) for member in self.members]
+
+    def _asdict(self):
+        values = self.record._asdict()
+        values['cluster_id'] = self.cluster_id
+        values['sources'] = sorted({member.source for member in self.members})
+        values['provenance'] = self.provenance
+        return values
+
+    def __repr__(self):
+        return f'Cluster({self.record!r}, {len(self.members)} members)'
+
+
+def title_shingles(title, size=cfg['shingle_size']):
+    title = normalize_title(title)
+    if not title:
+        return None
+    if len(title) <= size:
+        return {title}
+    return {title[i:i + size] for i in range(len(title) - size + 1)}
+
+def first_author_tokens(record):
+    # name tokens of the first author, 'Smith J.' and 'John Smith' share 'smith'
+    if not record.author:
+        return None
+    name = normalize_title(record.author[0])
+    return {token for token in name.split() if len(token) > 1} if name else None
+
+def is_duplicate(signatures, years, authors, dois, i, j, threshold):
+    if dois[i] and dois[j]:
+        # records with different dois were already kept apart by the doi join
+        return False
+    if years[i] is not None and years[j] is not None and abs(years[i] - years[j]) > cfg['year_tolerance']:
+        return False
+    if authors[i] and authors[j] and not authors[i] & authors[j]:
+        return False
+    return np.count_nonzero(signatures[i] == signatures[j]) >= threshold * len(signatures[i])
+
+def join_on_doi(records, clusters):
+    first_by_doi = {}
+    dois = []
+    for i, record in enumerate(records):
+        doi = normalize_doi(record.doi)
+        dois.append(doi)
+        if doi is None:
+            continue
+        if doi in first_by_doi:
+            clusters.union(first_by_doi[doi], i)
+        else:
+            first_by_doi[doi] = i
+    logger.info(f'Joined {len(records)} records on {len(first_by_doi)} dois')
+    return dois
+
+def match_titles(records, clusters, dois, hasher=None, bands=cfg['bands'], threshold=cfg['threshold']):
+    hasher = hasher or MinHasher()
+    rows = hasher.num_perm // bands
+    # one representative per doi group and every record without a doi take part
+    candidates = []
+    represented = set()
+    for i, record in enumerate(records):
+        if not record.title:
+            continue
+        if dois[i] is not None:
+            if clusters.find(i) in represented:
+                continue
+            represented.add(clusters.find(i))
+        candidates.append(i)
+    signatures = {}
+    band_keys = {}
+    years = {}
+    authors = {}
+    buckets = defaultdict(list)
+    for i in candidates:
+        shingles = title_shingles(records[i].title)
+        if not shingles:
+            continue
+        signatures[i] = hasher.signature(list(shingles))
+        band_keys[i] = [(band, signatures[i][band * rows:(band + 1) * rows].tobytes()) for band in range(bands)]
+        years[i] = record_year(records[i])
+        authors[i] = first_author_tokens(records[i])
+        for band_key in band_keys[i]:
+            buckets[band_key + (years[i],)].append(i)
+    # a record is compared to the bucket members of neighbouring years and of records without a year,
+    # records without a year are found by the records that have one
+    offsets = range(-cfg['year_tolerance'], cfg['year_tolerance'] + 1)
+    compared = set()
+    matches = 0
+    for i in signatures:
+        blocks = [None] if years[i] is None else [years[i] + offset for offset in offsets] + [None]
+        for band_key in band_keys[i]:
+            for year in blocks:
+                for j in buckets.get(band_key + (year,), ()):
+                    if j == i:
+                        continue
+                    pair = (i, j) if i < j else (j, i)
+                    if pair in compared:
+                        continue
+                    compared.add(pair)
+                    if is_duplicate(signatures, years, authors, dois, i, j, threshold):
+                        clusters.union(i, j)
+                        matches += 1
+    logger.info(f'Matched {matches} title pairs among {len(compared)} candidate pairs of {len(signatures)} titles')
+
+def merge_records(members, source_priority=cfg['source_priority']):
+    # fields missing in the preferred record are filled from the other members
+    rank = {source: i for i, source in enumerate(source_priority)}
+    members = sorted(members, key=lambda member: rank.get(member.source, len(rank)))
+    values = {}
+    for field in RECORD_FIELDS:
+        values[field] = next((getattr(member, field) for member in members if getattr(member, field) is not None), None)
+    values['source'] = members[0].source
+    return Cluster(Record(**values), members)
+
+def deduplicate(records):
+    # records of any number of sources, e.g. chained utils.records.to_records generators
+    records = list(records)
+    clusters = UnionFind(len(records))
+    dois = join_on_doi(records, clusters)
+    match_titles(records, clusters, dois)
+    groups = defaultdict(list)
+    for i, record in enumerate(records):
+        groups[clusters.find(i)].append(record)
+    result = [merge_records(members) for members in groups.values()]
+    # clusters kept apart can share the title hash key of records without doi or identifier, later ones are numbered
+    counts = defaultdict(int)
+    for cluster in result:
+        counts[cluster.cluster_id] += 1
+        if counts[cluster.cluster_id] > 1:
+            cluster.cluster_id = f'{cluster.cluster_id}#{counts[cluster.cluster_id]}'
+    logger.info(f'Deduplicated {len(records)} records into {len(result)} records')
+    return result
+
+def load_stored_records(db_name, table_name, source, kind='search_results'):
+    # kind None for tables stored under the record field names, e.g. harvested arxiv results
+    with get_engine(db_name).connect() as connection:
+        df = pd.read_sql_query(f'SELECT * FROM {quote(table_name)}', connection)
+    return to_records(source, df, kind)
+
+def store_deduplicated_records(db_name, clusters, table_name=cfg['results_table'], mode='replace'):
+    return store_records_in_sqlite(db_name, table_name, clusters, mode=mode, id_column='cluster_id')
@@ -0,0 +1,47 @@
+import re
+from utils.query import WORD_START, iter_terms, parse_search_string, query_groups, term_pattern, to_predicate
+
+# Matches every AND-group of a search string against a text in one pass.
+# All terms of the parsed search string are compiled into a single alternation wrapped in a lookahead and
+# anchored at word starts, so the scanner reports every position where any term starts without
+# backtracking over leading '.*'. Each group is then evaluated on the set of terms found, so nesting and
+# negations follow the parsed search string. Terms keep the database wildcard semantics: '*' any word characters, '?' one character.
+
+
+class BooleanQueryMatcher:
+    def __init__(self, search_string):
+        # group keys are the top level AND operands of the search string as used by the TITLE-KEYWORD queries
+        groups = query_groups(parse_search_string(search_string))
+        self.groups = [key for key, _ in groups]
+        self._predicates = [to_predicate(group) for _, group in groups]
+        self._terms = list(dict.fromkeys(term for _, group in groups for term in iter_terms(group)))
+        self._patterns = [re.compile(f'{WORD_START}{term_pattern(term)}', re.IGNORECASE) for term in self._terms]
+        # first character of terms starting with a literal, other terms are checked at every position
+        self._first_chars = [term.text[0].lower() if term.text[0] not in '*?' else None for term in self._terms]
+        alternatives = [f'(?P<t{i}>{term_pattern(term)})' for i, term in enumerate(self._terms)]
+        self._scanner = re.compile(f'{WORD_START}(?=(?:{"|".join(alternatives)}))', re.IGNORECASE)
+
+    def found_terms(self, text):
+        found = set()
+        positions = []
+        for match in self._scanner.finditer(text):
+            found.add(int(match.lastgroup[1:]))
+            positions.append(match.start())
+        # several terms can start at the same position but only the first one is reported,
+        # so the other terms are checked again at the known match positions only
+        for i, pattern in enumerate(self._patterns):
+            if i in found:
+                continue
+            first_char = self._first_chars[i]
+            if any((first_char is None or text[position].lower() == first_char) and pattern.match(text, position) for position in positions):
+                found.add(i)
+        return {self._terms[i] for i in found}
+
+    def matching_groups(self, text):
+        # returns the keys of all groups satisfied by the terms found in text
+        found = self.found_terms(text)
+        return {group for group, predicate in zip(self.groups, self._predicates) if predicate(found)}
+
+    def matches(self, text):
+        found = self.found_terms(text)
+        return all(predicate(found) for predicate in self._predicates)
@@ -0,0 +1,309 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import pickle
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils.utils import setup_logger
+
+logger = setup_logger('pipeline', r'.\\logs\\pipeline.log', level=logging.INFO)
+
+# A run is a graph of stages. A stage starts as soon as the stages it takes as inputs are finished, so
+# independent branches (e.g. one per database) run at the same time and the run takes about as long as its
+# slowest branch. Stages sharing a resource (e.g. the rate limit of one api) run at most limits[resource] at a time.
+# A streaming stage returns an iterable; its dependents start right away and get an iterator over the items
+# as they are produced instead of the finished result. A partial stage also runs if some of its inputs failed
+# and gets None for them, e.g. to merge the databases that could be searched.
+# With a checkpoint database, the result of every stage is stored under a fingerprint of its params, its
+# version and the fingerprints of its inputs. A stage whose fingerprint is stored is not run again and the
+# stages only it depended on are skipped as well, so changing e.g. the inclusion criteria re-runs only the
+# stages that depend on them. Streaming stages and stages with checkpoint=False always run.
+
+END_OF_STREAM = object()
+
+
+class Stream:
+    # bounded queue between a streaming stage and one of its dependents
+    def __init__(self, maxsize):
+        self._queue = queue.Queue(maxsize)
+        self.error = None
+        self.abandoned = False
+
+    def put(self, item):
+        # items for a dependent that stopped reading are dropped instead of blocking the producer
+        while not self.abandoned:
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self, error=None):
+        self.error = error
+        self.put(END_OF_STREAM)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is END_OF_STREAM:
+                    if self.error is not None:
+                        raise RuntimeError('Streaming input stage failed') from self.error
+                    return
+                yield item
+        finally:
+            self.abandoned = True
+
+
+def fingerprint_default(value):
+    if dataclasses.is_dataclass(value):
+        return dataclasses.asdict(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    return str(value)
+
+def fingerprint(*values):
+    content = json.dumps(values, sort_keys=True, default=fingerprint_default)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class StageCheckpoints:
+    # pickled stage results by stage name and fingerprint, every fingerprint is kept so switching back to an
+    # earlier search string reuses its results as well
+    def __init__(self, db_name):
+        self.db_name = db_name
+        if os.path.dirname(db_name):
+            os.makedirs(os.path.dirname(db_name), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_name, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS stage_checkpoints ('
+            'stage TEXT, fingerprint TEXT, value BLOB, created_at REAL, PRIMARY KEY (stage, fingerprint))'
+        )
+        self._connection.commit()
+
+    def contains(self, stage, fingerprint):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT 1 FROM stage_checkpoints WHERE stage = ? AND fingerprint = ?', (stage, fingerprint)
+            ).fetchone() is not None
+
+    def load(self, stage, fingerprint):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value FROM stage_checkpoints WHERE stage = ? AND fingerprint = ?', (stage, fingerprint)
+            ).fetchone()
+        return pickle.loads(row[0])
+
+    def save(self, stage, fingerprint, value):
+        value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO stage_checkpoints (stage, fingerprint, value, created_at) VALUES (?, ?, ?, ?)',
+                (stage, fingerprint, value, time.time())
+            )
+            self._connection.commit()
+
+    def clear(self, stage=None):
+        with self._lock:
+            if stage is None:
+                self._connection.execute('DELETE FROM stage_checkpoints')
+            else:
+                self._connection.execute('DELETE FROM stage_checkpoints WHERE stage = ?', (stage,))
+            self._connection.commit()
+
+
+class Stage:
+    # params and version identify everything besides the inputs the result depends on,
+    # e.g. the search string, the criteria applied by the api and the version constant of the connector
+    def __init__(self, name, func, inputs=(), resource=None, stream=False, partial=False, params=None, version=None, checkpoint=True):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.resource = resource
+        self.stream = stream
+        self.partial = partial
+        self.params = params
+        self.version = version
+        self.checkpoint = checkpoint and not stream
+
+    def __repr__(self):
+        return f'Stage({self.name!r}, inputs={self.inputs!r}, resource={self.resource!r})'
+
+
+class Pipeline:
+    def __init__(self, limits=None, stream_buffer=1000, checkpoint_db=None):
+        self.stages = {}
+        self.checkpoints = StageCheckpoints(checkpoint_db) if checkpoint_db else None
+        self.fingerprints = {}
+        self.reused = set()
+        self.limits = {resource: threading.Semaphore(limit) for resource, limit in (limits or {}).items()}
+        self.stream_buffer = stream_buffer
+        self.results = {}
+        self.failed = {}
+        self.timings = {}
+
+    def add(self, name, func, inputs=(), resource=None, stream=False, partial=False, params=None, version=None, checkpoint=True):
+        if name in self.stages:
+            raise ValueError(f'Stage {name} already exists')
+        self.stages[name] = Stage(name, func, inputs, resource, stream, partial, params, version, checkpoint)
+        return func
+
+    def stage(self, name=None, inputs=(), resource=None, stream=False, partial=False, params=None, version=None, checkpoint=True):
+        # decorator, the stage is named after the function by default
+        def decorator(func):
+            return self.add(name or func.__name__, func, inputs, resource, stream, partial, params, version, checkpoint)
+        return decorator
+
+    def _required(self, targets):
+        # the targets and all stages they depend on, in dependency order
+        order = []
+        visiting = set()
+        def visit(name, path):
+            if name not in self.stages:
+                raise ValueError(f'Unknown stage {name} required by {path[-1] if path else "run"}')
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f'Cycle between stages: {" -> ".join(path + [name])}')
+            visiting.add(name)
+            for input_name in self.stages[name].inputs:
+                visit(input_name, path + [name])
+            visiting.discard(name)
+            order.append(name)
+        for target in targets:
+            visit(target, [])
+        return order
+
+    def _execute(self, stage, args, streams, checkpoint=True):
+        semaphore = self.limits.get(stage.resource)
+        if semaphore:
+            semaphore.acquire()
+        start = time.time()
+        logger.info(f'Started stage {stage.name}')
+        try:
+            result = stage.func(*args)
+            if stage.stream:
+                count = 0
+                for item in result:
+                    for stream in streams:
+                        stream.put(item)
+                    count += 1
+                for stream in streams:
+                    stream.close()
+                logger.info(f'Stage {stage.name} streamed {count} items')
+                result = None
+            if checkpoint and stage.checkpoint and self.checkpoints:
+                try:
+                    self.checkpoints.save(stage.name, self.fingerprints[stage.name], result)
+                except (pickle.PicklingError, TypeError, AttributeError) as e:
+                    logger.error(f'Could not store checkpoint of stage {stage.name}: {e}')
+            return result
+        except BaseException as e:
+            for stream in streams:
+                stream.close(e)
+            raise
+        finally:
+            # a dependent that stopped reading its streaming inputs does not hold up their producers
+            for arg in args:
+                if isinstance(arg, Stream):
+                    arg.abandoned = True
+            if semaphore:
+                semaphore.release()
+            self.timings[stage.name] = time.time() - start
+            logger.info(f'Finished stage {stage.name} after {self.timings[stage.name]:.1f} s')
+
+    def _plan(self, order, targets):
+        # fingerprints of all stages, then the stages to run walking back from the targets:
+        # a stage with a stored result is reused and the stages only it depends on are not run
+        for name in order:
+            stage = self.stages[name]
+            self.fingerprints[name] = fingerprint(name, stage.version, stage.params, [self.fingerprints[input_name] for input_name in stage.inputs])
+        reusable = {
+            name for name in order
+            if self.checkpoints and self.stages[name].checkpoint and self.checkpoints.contains(name, self.fingerprints[name])
+        }
+        required = set()
+        def visit(name):
+            if name in required:
+                return
+            required.add(name)
+            if name not in reusable:
+                for input_name in self.stages[name].inputs:
+                    visit(input_name)
+        for target in targets:
+            visit(target)
+        return [name for name in order if name in required], reusable & required
+
+    def run(self, targets=None, raise_errors=True):
+        # runs the targets (default the stages no other stage depends on) and what they depend on, returns the results by stage name
+        if targets is None:
+            inputs = {input_name for stage in self.stages.values() for input_name in stage.inputs}
+            targets = [name for name in self.stages if name not in inputs]
+        order, reusable = self._plan(self._required(targets), targets)
+        for name in reusable:
+            self.results[name] = self.checkpoints.load(name, self.fingerprints[name])
+            self.reused.add(name)
+            logger.info(f'Reusing the stored result of stage {name}')
+        order = [name for name in order if name not in reusable]
+        finished = set(self.reused)
+        pending = list(order)
+        streams = {name: {} for name in order}
+        for name in order:
+            for input_name in self.stages[name].inputs:
+                if self.stages[input_name].stream and input_name in streams:
+                    streams[input_name][name] = Stream(self.stream_buffer)
+        started = set()
+        running = {}
+        start = time.time()
+        # every stage gets its own thread, the resource limits decide how many of them do work
+        with ThreadPoolExecutor(max_workers=max(len(order), 1)) as executor:
+            while pending or running:
+                for name in list(pending):
+                    stage = self.stages[name]
+                    failed_inputs = [input_name for input_name in stage.inputs if input_name in self.failed]
+                    if failed_inputs and not (stage.partial and len(failed_inputs) < len(stage.inputs)):
+                        pending.remove(name)
+                        self.failed[name] = RuntimeError(f'Skipped, input stages failed: {", ".join(failed_inputs)}')
+                        logger.error(f'Skipping stage {name}, input stages failed: {", ".join(failed_inputs)}')
+                        for stream in streams[name].values():
+                            stream.close(self.failed[name])
+                        for input_name in stage.inputs:
+                            if name in streams[input_name]:
+                                streams[input_name][name].abandoned = True
+                        continue
+                    if not all(
+                        input_name in finished or input_name in self.failed or (self.stages[input_name].stream and input_name in started)
+                        for input_name in stage.inputs
+                    ):
+                        continue
+                    args = [
+                        None if input_name in self.failed else
+                        streams[input_name][name] if self.stages[input_name].stream else self.results[input_name]
+                        for input_name in stage.inputs
+                    ]
+                    pending.remove(name)
+                    started.add(name)
+                    # results of a partial stage with failed inputs are not stored under the fingerprint of the full inputs
+                    running[executor.submit(self._execute, stage, args, list(streams[name].values()), not failed_inputs)] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                        finished.add(name)
+                    except Exception as e:
+                        self.failed[name] = e
+                        logger.error(f'Stage {name} failed: {e}', exc_info=e)
+        logger.info(f'Finished {len(finished) - len(self.reused)} stages and reused {len(self.reused)} in {time.time() - start:.1f} s, stage times: ' + ', '.join(f'{name} {seconds:.1f} s' for name, seconds in self.timings.items()))
+        if self.failed and raise_errors:
+            raise RuntimeError(f'Stages failed: {", ".join(self.failed)}')
+        return self.results
@@ -0,0 +1,322 @@
+import functools
+import itertools
+import logging
+import re
+from typing import NamedTuple
+from utils.utils import setup_logger
+
+logger = setup_logger('query', r'.\\logs\\query.log', level=logging.INFO)
+
+# Search strings are parsed once into a tree and every database gets its query generated from the tree.
+# Syntax: "quoted phrases", bare words, '*' any word characters, '?' one character, '-' or NOT negation,
+# brackets for nesting. As in Scopus, OR binds tighter than AND, so 'a OR b AND -c' is '(a OR b) AND NOT c',
+# and operands next to each other without an operator are AND-ed.
+# Nodes are tuples, so generators are memoized per node and shared subtrees are rendered once.
+
+TOKEN = re.compile(r'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<phrase>[^"]*)"|(?P<negation>-)|(?P<word>[^\s()"]+))')
+OPERATORS = {'AND', 'OR', 'NOT'}
+WORD_START = r'(?<!\w)'
+WORD_END = r'(?!\w)'
+
+
+def node_eq(self, other):
+    # tuples compare by their items only, And((a, b)) would equal Or((a, b)) and share their cache entries
+    return type(self) is type(other) and tuple.__eq__(self, other)
+
+def node_ne(self, other):
+    return not node_eq(self, other)
+
+def node_hash(self):
+    return hash((type(self).__name__, tuple(self)))
+
+
+class Term(NamedTuple):
+    text: str
+    phrase: bool = False
+    __eq__, __ne__, __hash__ = node_eq, node_ne, node_hash
+
+class Not(NamedTuple):
+    operand: object
+    __eq__, __ne__, __hash__ = node_eq, node_ne, node_hash
+
+class And(NamedTuple):
+    operands: tuple
+    __eq__, __ne__, __hash__ = node_eq, node_ne, node_hash
+
+class Or(NamedTuple):
+    operands: tuple
+    __eq__, __ne__, __hash__ = node_eq, node_ne, node_hash
+
+
+def tokenize(search_string):
+    tokens = []
+    position = 0
+    search_string = search_string.rstrip()
+    while position < len(search_string):
+        match = TOKEN.match(search_string, position)
+        if not match:
+            raise ValueError(f'Unbalanced quotes in search string at position {position}: {search_string[position:]}')
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'word' and value in OPERATORS:
+            kind = value
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    def __init__(self, search_string):
+        self.search_string = search_string
+        self.tokens = tokenize(search_string)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def take(self, kind=None):
+        if kind is not None and self.peek() != kind:
+            raise ValueError(f'Expected {kind} instead of {self.peek()} at token {self.position} of: {self.search_string}')
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self.parse_and()
+        if self.peek() is not None:
+            raise ValueError(f'Unexpected {self.peek()} at token {self.position} of: {self.search_string}')
+        return node
+
+    def parse_and(self):
+        operands = [self.parse_or()]
+        while True:
+            if self.peek() == 'AND':
+                self.take()
+            elif self.peek() not in ('open', 'phrase', 'word', 'negation', 'NOT'):
+                break
+            # operands without an operator in between are AND-ed
+            operands.append(self.parse_or())
+        return combine(And, operands)
+
+    def parse_or(self):
+        operands = [self.parse_unary()]
+        while self.peek() == 'OR':
+            self.take()
+            operands.append(self.parse_unary())
+        return combine(Or, operands)
+
+    def parse_unary(self):
+        if self.peek() in ('negation', 'NOT'):
+            self.take()
+            return Not(self.parse_unary())
+        if self.peek() == 'open':
+            self.take()
+            node = self.parse_and()
+            self.take('close')
+            return node
+        if self.peek() == 'phrase':
+            return Term(self.take()[1].strip(), True)
+        if self.peek() == 'word':
+            return Term(self.take()[1])
+        raise ValueError(f'Expected a term instead of {self.peek()} at token {self.position} of: {self.search_string}')
+
+
+def combine(operator, operands):
+    # bracketed operands stay nodes of their own, they are the groups the search string was written in
+    return operands[0] if len(operands) == 1 else operator(tuple(operands))
+
+@functools.lru_cache(maxsize=None)
+def parse_search_string(search_string):
+    return Parser(search_string).parse()
+
+def query_groups(query):
+    # top level AND operands, keyed by their search string
+    operands = query.operands if isinstance(query, And) else (query,)
+    return [(to_search_string(operand), operand) for operand in operands]
+
+def iter_terms(node):
+    if isinstance(node, Term):
+        yield node
+    elif isinstance(node, Not):
+        yield from iter_terms(node.operand)
+    else:
+        for operand in node.operands:
+            yield from iter_terms(operand)
+
+def split_negations(node):
+    # AND operands into positive and negated operands, most query languages only know 'a AND NOT b'
+    operands = node.operands if isinstance(node, And) else (node,)
+    positive = [operand for operand in operands if not isinstance(operand, Not)]
+    negative = [operand.operand for operand in operands if isinstance(operand, Not)]
+    return positive, negative
+
+def expand_single_wildcards(text):
+    # '?' as spelling variants for databases without a single character wildcard: 'thin?film' is
+    # 'thin film' or 'thinfilm', hyphenated spellings are tokenized like the one with a space
+    parts = text.split('?')
+    return [
+        parts[0] + ''.join(separator + part for separator, part in zip(separators, parts[1:]))
+        for separators in itertools.product((' ', ''), repeat=len(parts) - 1)
+    ]
+
+
+# canonical search string, e.g. as key of the top level groups
+
+@functools.lru_cache(maxsize=None)
+def to_search_string(node):
+    if isinstance(node, Term):
+        return f'"{node.text}"' if node.phrase else node.text
+    if isinstance(node, Not):
+        return f'-{bracket(node.operand, to_search_string)}'
+    operator = ' AND ' if isinstance(node, And) else ' OR '
+    return operator.join(bracket(operand, to_search_string) for operand in node.operands)
+
+def bracket(node, generator, *args):
+    # compound operands are always bracketed, the databases disagree on operator precedence
+    query = generator(node, *args)
+    return f'({query})' if isinstance(node, (And, Or)) else query
+
+def join_with_negations(node, generator, *args, and_operator='AND', not_operator='AND NOT'):
+    positive, negative = split_negations(node)
+    if not positive:
+        logger.error(f'Negations need a positive operand: {to_search_string(node)}')
+        positive, negative = [Not(operand) for operand in negative], []
+    query = f' {and_operator} '.join(bracket(operand, generator, *args) for operand in positive)
+    for operand in negative:
+        query += f' {not_operator} {bracket(operand, generator, *args)}'
+    return query
+
+
+# Scopus: loose phrases in quotes keep '*' and '?', 'AND NOT' for negations
+
+@functools.lru_cache(maxsize=None)
+def to_scopus_expression(node):
+    if isinstance(node, Term):
+        return f'"{node.text}"' if node.phrase else node.text
+    if isinstance(node, Not):
+        logger.error(f'Negation without a positive operand: {to_search_string(node)}')
+        return f'NOT {bracket(node.operand, to_scopus_expression)}'
+    if isinstance(node, Or):
+        return ' OR '.join(bracket(operand, to_scopus_expression) for operand in node.operands)
+    return join_with_negations(node, to_scopus_expression)
+
+@functools.lru_cache(maxsize=None)
+def to_scopus_query(node, field='TITLE-ABS-KEY'):
+    return f'{field}({to_scopus_expression(node)})'
+
+
+# arXiv: field prefix on every term, ANDNOT for negations, no wildcards inside phrases
+
+@functools.lru_cache(maxsize=None)
+def to_arxiv_query(node, field='all'):
+    if isinstance(node, Term):
+        variants = []
+        for text in expand_single_wildcards(node.text):
+            words = text.split()
+            if '*' in text and len(words) > 1:
+                # a truncated word in a phrase becomes an AND of the words, the phrase is checked locally
+                variants.append('(' + ' AND '.join(f'{field}:{word}' for word in words) + ')')
+            elif len(words) > 1:
+                variants.append(f'{field}:"{text}"')
+            else:
+                variants.append(f'{field}:{text}')
+        return variants[0] if len(variants) == 1 else '(' + ' OR '.join(variants) + ')'
+    if isinstance(node, Not):
+        logger.error(f'arXiv only supports ANDNOT, negation without a positive operand is dropped: {to_search_string(node)}')
+        return ''
+    if isinstance(node, Or):
+        if any(isinstance(operand, Not) for operand in node.operands):
+            logger.error(f'OR NOT not supported by arxiv API, the negation is dropped: {to_search_string(node)}')
+        return ' OR '.join(bracket(operand, to_arxiv_query, field) for operand in node.operands if not isinstance(operand, Not))
+    return join_with_negations(node, to_arxiv_query, field, not_operator='ANDNOT')
+
+
+# Springer: each term searched in all given fields, '-' for negations, '?' expanded to its spellings
+
+@functools.lru_cache(maxsize=None)
+def to_springer_query(node, fields=None):
+    if isinstance(node, Term):
+        texts = [f'"{text}"' if node.phrase else text for text in expand_single_wildcards(node.text)]
+        terms = [f'{field}:{text}' for text in texts for field in fields] if fields else texts
+        return terms[0] if len(terms) == 1 else '(' + ' OR '.join(terms) + ')'
+    if isinstance(node, Not):
+        return f'-({to_springer_query(node.operand, fields)})'
+    operator = ' AND ' if isinstance(node, And) else ' OR '
+    return operator.join(bracket(operand, to_springer_query, fields) for operand in node.operands)
+
+
+# ACM: one query per field joined with OR, NOT for negations
+
+@functools.lru_cache(maxsize=None)
+def to_acm_expression(node):
+    if isinstance(node, Term):
+        return f'"{node.text}"' if node.phrase else node.text
+    if isinstance(node, Not):
+        return f'NOT {bracket(node.operand, to_acm_expression)}'
+    if isinstance(node, Or):
+        return ' OR '.join(bracket(operand, to_acm_expression) for operand in node.operands)
+    return join_with_negations(node, to_acm_expression, not_operator='AND NOT')
+
+@functools.lru_cache(maxsize=None)
+def to_acm_query(node, fields=('Title', 'Abstract', 'Keyword')):
+    expression = to_acm_expression(node)
+    return ' OR '.join(f'{field}:({expression})' for field in fields)
+
+
+# IEEE Xplore boolean_text: binary NOT, optional "Field Name": prefix on every term
+
+@functools.lru_cache(maxsize=None)
+def to_ieee_query(node, field=None):
+    if isinstance(node, Term):
+        text = f'"{node.text}"' if node.phrase else node.text
+        return f'("{field}":{text})' if field else text
+    if isinstance(node, Not):
+        logger.error(f'Negation without a positive operand: {to_search_string(node)}')
+        return f'NOT {bracket(node.operand, to_ieee_query, field)}'
+    if isinstance(node, Or):
+        return ' OR '.join(bracket(operand, to_ieee_query, field) for operand in node.operands)
+    return join_with_negations(node, to_ieee_query, field, not_operator='NOT')
+
+
+# local matching: wildcards keep the database semantics, terms match at word boundaries
+
+@functools.lru_cache(maxsize=None)
+def term_pattern(term):
+    pattern = ''.join(r'\w*' if char == '*' else '.' if char == '?' else re.escape(char) for char in term.text)
+    return f'{pattern}{WORD_END}'
+
+@functools.lru_cache(maxsize=None)
+def to_regex(node):
+    # zero width assertions from the start of a text, e.g. re.match(to_regex(node), text, re.IGNORECASE | re.DOTALL)
+    if isinstance(node, Term):
+        return f'(?=.*?{WORD_START}{term_pattern(node)})'
+    if isinstance(node, Not):
+        return f'(?!{to_regex(node.operand)})'
+    if isinstance(node, Or):
+        return '(?:' + '|'.join(to_regex(operand) for operand in node.operands) + ')'
+    return ''.join(to_regex(operand) for operand in node.operands)
+
+@functools.lru_cache(maxsize=None)
+def to_predicate(node):
+    # evaluates node on the set of terms found in a text
+    if isinstance(node, Term):
+        return lambda found: node in found
+    if isinstance(node, Not):
+        predicate = to_predicate(node.operand)
+        return lambda found: not predicate(found)
+    predicates = [to_predicate(operand) for operand in node.operands]
+    if isinstance(node, Or):
+        return lambda found: any(predicate(found) for predicate in predicates)
+    return lambda found: all(predicate(found) for predicate in predicates)
+
+
+GENERATORS = {
+    'scopus': to_scopus_query, 'arxiv': to_arxiv_query, 'springer': to_springer_query,
+    'acm': to_acm_query, 'ieee': to_ieee_query, 'regex': to_regex, 'search_string': to_search_string
+}
+
+@functools.lru_cache(maxsize=None)
+def compile_query(search_string, backend, *args):
+    query = GENERATORS[backend](parse_search_string(search_string), *args)
+    logger.info(f'{backend} query of {search_string}:\n{query}')
+    return query
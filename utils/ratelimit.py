@@ -0,0 +1,37 @@
+import functools
+import threading
+import time
+
+# ratelimiter.RateLimiter records a call when it returns, so threads sharing it all start their first calls
+# at once. RequestLimiter reserves the next free slot when a request is acquired, requests of all threads
+# sharing a limiter start at least 1 / requests_per_second apart.
+
+
+class RequestLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __call__(self, func):
+        # as decorator every call of func takes a slot
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.acquire()
+            return func(*args, **kwargs)
+        return wrapper
@@ -0,0 +1,284 @@
+import datetime
+import functools
+import hashlib
+import json
+import re
+import sys
+import unicodedata
+from config import cfg
+
+DOI_PREFIXES = ('https://doi.org/', 'http://doi.org/', 'https://dx.doi.org/', 'http://dx.doi.org/', 'doi.org/', 'doi:')
+NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+
+
+def normalize_doi(doi):
+    if not doi or not isinstance(doi, str):
+        return None
+    doi = doi.strip().lower()
+    for prefix in DOI_PREFIXES:
+        if doi.startswith(prefix):
+            doi = doi[len(prefix):]
+            break
+    return doi or None
+
+def normalize_title(title):
+    if not title or not isinstance(title, str):
+        return None
+    # strip accents, case and punctuation so spelling variants of a title compare equal
+    title = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore').decode('ascii').lower()
+    title = NON_ALPHANUMERIC.sub(' ', title).strip()
+    return title or None
+
+def get_field(record, field):
+    if field is None:
+        return None
+    if isinstance(record, dict):
+        return record.get(field)
+    return getattr(record, field, None)
+
+def record_key(record, doi_field='doi', identifier_field='identifier', title_field='title'):
+    # stable identity of a record: DOI, then source identifier, then a hash of the normalized title
+    doi = normalize_doi(get_field(record, doi_field))
+    if doi:
+        return f'doi:{doi}'
+    identifier = get_field(record, identifier_field)
+    if identifier:
+        identifier = str(identifier)
+        # springer identifiers are prefixed dois
+        if identifier.lower().startswith('doi:'):
+            return f'doi:{normalize_doi(identifier)}'
+        return f'id:{identifier}'
+    title = normalize_title(get_field(record, title_field))
+    if title:
+        return f'title:{hashlib.sha1(title.encode("utf-8")).hexdigest()}'
+    # records without any identity compare by content
+    content = json.dumps(record if isinstance(record, dict) else vars(record), sort_keys=True, default=str)
+    return f'record:{hashlib.sha1(content.encode("utf-8")).hexdigest()}'
+
+
+class RecordIndex:
+    # hash index over records by identity key, membership and set operations are O(1) per record
+    def __init__(self, records=(), key=record_key):
+        self.key = key
+        self.records = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        # the first record seen for a key is kept
+        self.records.setdefault(self.key(record), record)
+
+    def keys(self):
+        return self.records.keys()
+
+    def __contains__(self, record):
+        return self.key(record) in self.records
+
+    def contains_key(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def _from_keys(self, keys, indexes):
+        result = RecordIndex(key=self.key)
+        # keeps the record order of the indexes
+        for index in indexes:
+            for key, record in index.records.items():
+                if key in keys:
+                    result.records.setdefault(key, record)
+        return result
+
+    def union(self, *others):
+        indexes = (self,) + others
+        keys = set(self.records).union(*(other.records.keys() for other in others))
+        return self._from_keys(keys, indexes)
+
+    def intersection(self, *others):
+        keys = set(self.records).intersection(*(other.records.keys() for other in others))
+        return self._from_keys(keys, (self,))
+
+    def difference(self, *others):
+        keys = set(self.records).difference(*(other.records.keys() for other in others))
+        return self._from_keys(keys, (self,))
+
+
+# Unified record of all connectors. Slots instead of a per-instance dict keep records small, and
+# strings repeated across many records (subtype, publication name, subjects, ...) are interned so
+# every record shares one copy.
+RECORD_FIELDS = (
+    'source', 'title', 'identifier', 'doi', 'subtype', 'publication_name', 'aggregation_type', 'author', 'country',
+    'date', 'keywords', 'subject_areas', 'open_access', 'funded_by', 'abstract', 'cited_by_count', 'language', 'url'
+)
+INTERNED_FIELDS = {'source', 'subtype', 'publication_name', 'aggregation_type', 'country', 'language', 'open_access'}
+SOURCE_CONFIGS = {
+    'scopus': cfg.scopus, 'springer': cfg.springer, 'arxiv': cfg.arxiv, 'crossref': cfg.crossref,
+    'semantic_scholar': cfg.semantic_scholar, 'acm': cfg.acm, 'ieee': cfg.ieee
+}
+TERM_SEPARATORS = re.compile(r'\s*(?:\|| ;|;)\s*')
+YEAR = re.compile(r'\b(1[89]\d\d|20\d\d)\b')
+
+
+class Record:
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, **values):
+        for field in RECORD_FIELDS:
+            setattr(self, field, values.get(field))
+
+    def _asdict(self):
+        # same protocol as namedtuples, so records can be stored with utils.storage
+        return {field: getattr(self, field) for field in RECORD_FIELDS}
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and all(getattr(self, field) == getattr(other, field) for field in RECORD_FIELDS)
+
+    def __repr__(self):
+        values = ', '.join(f'{field}={getattr(self, field)!r}' for field in RECORD_FIELDS if getattr(self, field) is not None)
+        return f'Record({values})'
+
+
+def intern_value(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+def decode_list(value):
+    # lists read back from sqlite are json arrays, see utils.storage.to_sql_value
+    if isinstance(value, str) and value.startswith('['):
+        try:
+            decoded = json.loads(value)
+        except ValueError:
+            return value
+        return decoded if isinstance(decoded, list) else value
+    return value
+
+def to_names(value):
+    # author lists of all sources as a tuple of names
+    if value is None:
+        return None
+    value = decode_list(value)
+    if isinstance(value, str):
+        return tuple(name.strip() for name in value.split(';') if name.strip())
+    if isinstance(value, dict):
+        return to_names(value.get('authors'))
+    names = []
+    for author in value:
+        if isinstance(author, str):
+            names.append(author)
+        elif isinstance(author, dict):
+            name = author.get('name') or author.get('full_name') or author.get('creator') or ' '.join(filter(None, (author.get('given'), author.get('family'))))
+            if name:
+                names.append(name)
+        elif getattr(author, 'name', None):
+            names.append(author.name)
+    return tuple(names)
+
+def to_terms(value):
+    # keyword and subject lists of all sources as a tuple of interned strings
+    if value is None:
+        return None
+    value = decode_list(value)
+    if isinstance(value, str):
+        terms = TERM_SEPARATORS.split(value)
+    elif isinstance(value, dict):
+        # nested term groups, e.g. ieee index terms
+        terms = [term for group in value.values() for term in (to_terms(group) or ())]
+    else:
+        terms = []
+        for term in value:
+            if isinstance(term, dict) and 'terms' in term:
+                terms.extend(to_terms(term['terms']) or ())
+            elif isinstance(term, dict):
+                terms.append(term.get('category') or term.get('name'))
+            else:
+                terms.append(term)
+    return tuple(dict.fromkeys(sys.intern(term.strip()) for term in terms if isinstance(term, str) and term.strip()))
+
+def to_date(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.date().isoformat() if isinstance(value, datetime.datetime) else value.isoformat()
+    if isinstance(value, dict) and 'date-parts' in value:
+        # crossref dates, unknown dates come as [[None]], parts after an unknown part are dropped
+        parts = []
+        for part in (value['date-parts'] or [[]])[0]:
+            if part is None:
+                break
+            parts.append(part)
+        return '-'.join(f'{part:02d}' for part in parts) if parts else None
+    return value
+
+def to_doi(value):
+    # semantic scholar keeps the doi among its external ids
+    if isinstance(value, dict):
+        return value.get('DOI')
+    return value
+
+def to_text(value):
+    # single element lists, e.g. crossref titles
+    if isinstance(value, list):
+        return value[0] if len(value) == 1 else '; '.join(str(item) for item in value)
+    return value
+
+FIELD_CONVERTERS = {
+    'doi': to_doi, 'author': to_names, 'keywords': to_terms, 'subject_areas': to_terms, 'date': to_date,
+    'title': to_text, 'publication_name': to_text, 'aggregation_type': to_text, 'abstract': to_text
+}
+
+def field_getter(source_field):
+    # reads a field from dicts (json results, stored rows) and objects (namedtuples, dataclasses, arxiv results)
+    if isinstance(source_field, list):
+        getters = [field_getter(field) for field in source_field]
+        def get_combined(item):
+            values = [value for value in (get(item) for get in getters) if value is not None]
+            return [term for value in values for term in (value if isinstance(value, list) else [value])] or None
+        return get_combined
+    def get(item):
+        if isinstance(item, dict):
+            return item.get(source_field)
+        return getattr(item, source_field, None)
+    return get
+
+@functools.lru_cache(maxsize=None)
+def build_record_extractor(source, kind='search_results'):
+    # compiles the field mapping of source in config/cfg.py into one function from a source item to a Record
+    # a kind of None reads items already stored under the record field names, e.g. harvested arxiv results
+    if kind is None:
+        mapping = {field: field for field in RECORD_FIELDS if field != 'source'}
+    else:
+        mapping = SOURCE_CONFIGS[source]['field_mapping'][kind]
+    steps = []
+    for field, source_field in mapping.items():
+        if field not in RECORD_FIELDS or not source_field or source_field == 'TODO':
+            continue
+        convert = FIELD_CONVERTERS.get(field)
+        if field in INTERNED_FIELDS:
+            convert = (lambda value, convert=convert: intern_value(convert(value))) if convert else intern_value
+        steps.append((field, field_getter(source_field), convert))
+    source = sys.intern(source)
+
+    def extract(item):
+        record = Record(source=source)
+        for field, get, convert in steps:
+            value = get(item)
+            if value is None or value != value or value == '': # missing, NaN of DataFrame rows or empty
+                continue
+            setattr(record, field, convert(value) if convert else value)
+        return record
+    return extract
+
+def record_year(record):
+    # publication year of a Record from the date of any source, None if it has none
+    date = record.date
+    if isinstance(date, int):
+        return date
+    match = YEAR.search(str(date)) if date else None
+    return int(match.group(1)) if match else None
+
+def to_records(source, items, kind='search_results'):
+    # items can be any iterable of source results or a DataFrame of stored results
+    if hasattr(items, 'to_dict'):
+        items = items.to_dict('records')
+    extract = build_record_extractor(source, kind)
+    return (extract(item) for item in items)
@@ -1,27 +1,54 @@
 from pybliometrics.scopus import ScopusSearch, AbstractRetrieval
+from pybliometrics.exception import Scopus401Error, Scopus429Error
+import datetime
+import hashlib
+import json
+import logging
+import re
+import threading
 import pandas as pd
-from sqlalchemy import create_engine
-from sqlalchemy.engine import reflection
-from utils.utils import decompose_and_terms
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.utils import setup_logger
+from utils.ratelimit import RequestLimiter
+from utils.query import compile_query
+from utils.storage import get_engine, quote, store_records_in_sqlite, SQLiteRecordWriter
+from config.cfg import cache as cache_cfg
+from config.cfg import scopus as cfg
+from config.keys import apikey
+
+logger = setup_logger('scopus', r'.\\logs\\scopus.log', level=logging.INFO)
 
 MAX_BACKWARD_SEARCH_ITERATIONS = 3
+# part of the fingerprint of the pipeline stages, raise it when a change alters the results of the connector
+SCOPUS_CONNECTOR_VERSION = 2
 
-def convert_search_string_to_scopus(search_string):
-    # Split each OR conjunction separated by AND
-    and_terms = decompose_and_terms(search_string)
-    # replace '-' with NOT
-    and_terms = [x.replace('-', 'NOT ') for x in and_terms]
-    # TODO add support for other wildcards
-    # loop through each term and add TITLE-ABS-KEY( and ) to each term
-    and_terms = [f'TITLE-ABS-KEY({x})' for x in and_terms]
-    # join the terms with AND
-    search_string = ' AND '.join(and_terms)
-    
-    return search_string
+def convert_search_string_to_scopus(search_string, criteria=None):
+    # TITLE-ABS-KEY query generated from the parsed search string, negations become AND NOT
+    query = compile_query(search_string, 'scopus')
+    filters = build_scopus_filters(criteria) if criteria else []
+    return ' AND '.join([query] + filters)
+
+def build_scopus_filters(criteria):
+    # inclusion criteria as PUBYEAR, DOCTYPE and LANGUAGE conditions of the query
+    filters = []
+    if criteria.years:
+        year_low, year_high = criteria.years
+        if criteria.year_low is not None:
+            filters.append(f'PUBYEAR > {year_low - 1}')
+        if criteria.year_high is not None:
+            filters.append(f'PUBYEAR < {year_high + 1}')
+    document_types = criteria.native_document_types('scopus')
+    if document_types:
+        filters.append('DOCTYPE(' + ' OR '.join(document_types) + ')')
+    languages = criteria.native_languages('scopus')
+    if languages:
+        filters.append('LANGUAGE(' + ' OR '.join(languages) + ')')
+    return filters
 
 # Search scopus
 def search_scopus(query):
-    search = ScopusSearch(query)
+    # pybliometrics caches responses on disk, refresh them once they are older than the cache ttl
+    search = ScopusSearch(query, refresh=cache_cfg['scopus_refresh'])
     return search.results
 
 # Remove irrelevant rows from scopus search results
@@ -31,6 +58,117 @@ def remove_irrelevant_scopus_search_results(scopus_results_df):
     # TODO maybe remove other records later
     return scopus_results_df
 
+class ScopusQuotaExceeded(Exception):
+    pass
+
+
+class ScopusKeyPool:
+    # Hands out the configured api keys round robin. Every key has its own per second throttle
+    # and weekly quota, usage is persisted per ISO week so quotas hold across runs.
+    def __init__(self, keys, db_name, requests_per_second, weekly_quota):
+        # a single key can be configured as a string
+        self.keys = ([keys] if isinstance(keys, str) else list(keys)) or [None] # None lets pybliometrics pick keys from its config
+        self.db_name = db_name
+        self.weekly_quota = weekly_quota
+        self.week = '{}-W{:02d}'.format(*datetime.date.today().isocalendar()[:2])
+        # slots are reserved on entering the limiter, so the workers never call one key at the same moment
+        self._limiters = {key: RequestLimiter(requests_per_second) for key in self.keys}
+        self._exhausted = set()
+        self._next = 0
+        self._lock = threading.Lock()
+        self._used = self._load_usage()
+
+    @staticmethod
+    def key_id(key):
+        # keys themselves are not written to the database
+        return hashlib.sha256(str(key).encode('utf-8')).hexdigest()[:16]
+
+    def _load_usage(self):
+        table = cfg['abstract_retrieval']['key_usage_table']
+        with get_engine(self.db_name).begin() as connection:
+            connection.exec_driver_sql(f'CREATE TABLE IF NOT EXISTS {quote(table)} (key_id TEXT, week TEXT, calls INTEGER, PRIMARY KEY (key_id, week))')
+            rows = connection.exec_driver_sql(f'SELECT key_id, calls FROM {quote(table)} WHERE week = ?', (self.week,)).fetchall()
+        calls = dict(rows)
+        return {key: calls.get(self.key_id(key), 0) for key in self.keys}
+
+    def save_usage(self):
+        table = cfg['abstract_retrieval']['key_usage_table']
+        with get_engine(self.db_name).begin() as connection:
+            connection.exec_driver_sql(
+                f'INSERT OR REPLACE INTO {quote(table)} (key_id, week, calls) VALUES (?, ?, ?)',
+                [(self.key_id(key), self.week, calls) for key, calls in self._used.items()]
+            )
+
+    def acquire(self):
+        with self._lock:
+            for _ in range(len(self.keys)):
+                key = self.keys[self._next]
+                self._next = (self._next + 1) % len(self.keys)
+                if key not in self._exhausted and self._used[key] < self.weekly_quota:
+                    self._used[key] += 1
+                    return key, self._limiters[key]
+        raise ScopusQuotaExceeded('All Scopus api keys are exhausted for this week')
+
+    def exhaust(self, key):
+        with self._lock:
+            self._exhausted.add(key)
+            # saved as used up so later runs this week skip the key
+            self._used[key] = max(self._used[key], self.weekly_quota)
+        logger.warning(f'Scopus key {self.key_id(key)} exhausted')
+
+
+def retrieve_scopus_abstract(eid, key_pool: ScopusKeyPool, checkpointed=False):
+    if checkpointed:
+        # finished in an earlier run, pybliometrics loads it from its file cache without a request
+        return AbstractRetrieval(eid, id_type='eid', view='FULL', refresh=False)
+    while True:
+        key, limiter = key_pool.acquire()
+        kwds = {'apikey': key} if key else {}
+        try:
+            with limiter:
+                return AbstractRetrieval(eid, id_type='eid', view='FULL', refresh=cache_cfg['scopus_refresh'], **kwds)
+        except (Scopus429Error, Scopus401Error):
+            if key is None:
+                raise
+            key_pool.exhaust(key)
+
+def retrieve_scopus_abstracts(eids, db_name):
+    # Retrieves the abstracts of all eids with a pool of workers. Every finished eid is checkpointed,
+    # so an interrupted run continues with the eids that are still missing.
+    # Returns a dictionary eid: AbstractRetrieval in the order of eids, failed eids are left out.
+    settings = cfg['abstract_retrieval']
+    eids = list(dict.fromkeys(eids))
+    checkpoint_table = settings['checkpoint_table']
+    engine = get_engine(db_name)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f'CREATE TABLE IF NOT EXISTS {quote(checkpoint_table)} (eid TEXT PRIMARY KEY, status TEXT, retrieved_at TEXT)')
+        done = {row[0] for row in connection.exec_driver_sql(f'SELECT eid FROM {quote(checkpoint_table)} WHERE status = ?', ('done',))}
+    logger.info(f'Retrieving {len(eids)} abstracts, {len(done & set(eids))} of them checkpointed')
+    key_pool = ScopusKeyPool(apikey.get('scopus', []), db_name, settings['requests_per_second'], settings['weekly_quota'])
+    abstracts = {}
+    try:
+        with SQLiteRecordWriter(db_name, checkpoint_table, id_column='eid', batch_size=50) as checkpoint, \
+                ThreadPoolExecutor(max_workers=settings['max_workers']) as executor:
+            futures = {executor.submit(retrieve_scopus_abstract, eid, key_pool, eid in done): eid for eid in eids}
+            for future in as_completed(futures):
+                eid = futures[future]
+                try:
+                    abstracts[eid] = future.result()
+                    status = 'done'
+                except ScopusQuotaExceeded as e:
+                    logger.error(f'{e}, stopping abstract retrieval')
+                    for pending in futures:
+                        pending.cancel()
+                    break
+                except Exception as e:
+                    logger.error(f'Error retrieving abstract of {eid}: {e}')
+                    status = 'failed'
+                checkpoint.write({'eid': eid, 'status': status, 'retrieved_at': datetime.datetime.now().isoformat()})
+    finally:
+        key_pool.save_usage()
+    logger.info(f'Retrieved {len(abstracts)}/{len(eids)} abstracts')
+    return {eid: abstracts[eid] for eid in eids if eid in abstracts}
+
 # Scopus abstract retrieval
 def retrieve_scopus_abstracts_from_search_results(search_results_df, db_name, backward_search_iteration=0):
     # Get the abstracts from the search results
@@ -45,8 +183,8 @@ def retrieve_scopus_abstracts_from_search_results(search_results_df, db_name, ba
     all_authkeywords = []
     all_references = []
     
-    for eid in search_results_df['eid']:
-        ab = AbstractRetrieval(eid, id_type='eid', view='FULL')
+    abstracts = retrieve_scopus_abstracts(search_results_df['eid'], db_name)
+    for eid, ab in abstracts.items():
         # check if abstract/description is not None and if description contains copyright prefix
         if ab.abstract is not None and ab.description is not None:
             if len(ab.description) > 0.9 * len(ab.abstract):
@@ -126,7 +264,9 @@ def retrieve_scopus_abstracts_from_search_results(search_results_df, db_name, ba
     if backward_search_iteration < MAX_BACKWARD_SEARCH_ITERATIONS:
         all_references['eid'] = '2-s2.0-' + all_references['id']
         all_references['backward_search_iteration'] = backward_search_iteration + 1
-        store_scopus_results_in_sqlite(db_name, 'references', all_references, mode='update')
+        # references found again in a later iteration keep the iteration they were first found in
+        counts = store_scopus_results_in_sqlite(db_name, 'references', all_references, mode='update', id_column='eid', keep_existing=('backward_search_iteration',))
+        logger.info(f'Stored references of backward search iteration {backward_search_iteration + 1}: {counts}')
         # create unique eid, references eid tuples
         eid_list = []
         reference_eid_list = []
@@ -147,23 +287,154 @@ def retrieve_scopus_abstracts_from_search_results(search_results_df, db_name, ba
     return abstract_retrieval_df
 
 
+def build_snowball_prefilter(year_low=None, year_high=None, subtypes=None, title_pattern=None):
+    # cheap check on the metadata that comes with a reference or citing document, before its abstract is retrieved
+    # missing metadata never excludes a candidate
+    title_regex = re.compile(title_pattern, re.IGNORECASE) if title_pattern else None
+    def prefilter(candidate):
+        try:
+            year = int(str(candidate.get('year'))[:4])
+        except ValueError:
+            year = None
+        if year is not None and year_low is not None and year < year_low:
+            return False
+        if year is not None and year_high is not None and year > year_high:
+            return False
+        if subtypes and candidate.get('subtype') and candidate['subtype'] not in subtypes:
+            return False
+        if title_regex and candidate.get('title') and not title_regex.search(candidate['title']):
+            return False
+        return True
+    return prefilter
+
+
+def get_snowball_id(seed_eids, max_depth, directions, scope=None):
+    # snowball searches from other seeds or with other settings keep their own tables
+    key = json.dumps([sorted(set(seed_eids)), max_depth, sorted(directions), scope], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+class SnowballState:
+    # Visited eids and the frontier queue of the breadth first snowball search, persisted in sqlite
+    # so an interrupted or budget limited search continues where it stopped.
+    def __init__(self, db_name, snowball_id):
+        settings = cfg['snowball']
+        self.engine = get_engine(db_name)
+        self.visited_table = f"{settings['visited_table']}_{snowball_id}"
+        self.frontier_table = f"{settings['frontier_table']}_{snowball_id}"
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(f'CREATE TABLE IF NOT EXISTS {quote(self.visited_table)} (eid TEXT PRIMARY KEY, depth INTEGER, status TEXT)')
+            connection.exec_driver_sql(f'CREATE TABLE IF NOT EXISTS {quote(self.frontier_table)} (eid TEXT PRIMARY KEY, depth INTEGER, parent_eid TEXT, direction TEXT)')
+            self.visited = {row[0] for row in connection.exec_driver_sql(f'SELECT eid FROM {quote(self.visited_table)}')}
+            self.frontier = {row[0]: row[1] for row in connection.exec_driver_sql(f'SELECT eid, depth FROM {quote(self.frontier_table)} ORDER BY rowid')}
+        self._pushed = []
+
+    def push(self, eid, depth, parent_eid, direction):
+        if eid in self.visited or eid in self.frontier:
+            return False
+        self.frontier[eid] = depth
+        self._pushed.append((eid, depth, parent_eid, direction))
+        return True
+
+    def next_level(self):
+        depth = min(self.frontier.values())
+        return depth, [eid for eid, eid_depth in self.frontier.items() if eid_depth == depth]
+
+    def mark_visited(self, eids_status, depth):
+        for eid, _ in eids_status:
+            self.visited.add(eid)
+            self.frontier.pop(eid, None)
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(
+                f'INSERT OR REPLACE INTO {quote(self.visited_table)} (eid, depth, status) VALUES (?, ?, ?)',
+                [(eid, depth, status) for eid, status in eids_status]
+            )
+            connection.exec_driver_sql(f'DELETE FROM {quote(self.frontier_table)} WHERE eid = ?', [(eid,) for eid, _ in eids_status])
+
+    def save(self):
+        if not self._pushed:
+            return
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(
+                f'INSERT OR IGNORE INTO {quote(self.frontier_table)} (eid, depth, parent_eid, direction) VALUES (?, ?, ?, ?)',
+                self._pushed
+            )
+        self._pushed = []
+
+
+def search_citing_documents(eid):
+    search = ScopusSearch(f'REFEID({eid})', refresh=cache_cfg['scopus_refresh'])
+    return search.results or []
+
+def snowball_scopus(seed_eids, db_name, max_depth=MAX_BACKWARD_SEARCH_ITERATIONS, budget=None, directions=None, prefilter=None, scope=None):
+    # Breadth first backward (references) and forward (citing documents) search starting at seed_eids.
+    # Every eid is retrieved at most once over all runs; candidates are checked by prefilter before they
+    # enter the frontier. Stops after max_depth levels or when budget new abstracts were retrieved.
+    # Visited eids, frontier and results are kept per seed set, depth, directions and scope (e.g. the arguments
+    # of the prefilter), only results of this search are returned. The citation edges are shared.
+    settings = cfg['snowball']
+    seed_eids = list(seed_eids)
+    directions = directions or settings['directions']
+    budget = budget if budget is not None else settings['budget']
+    snowball_id = get_snowball_id(seed_eids, max_depth, directions, scope)
+    results_table = f"{settings['results_table']}_{snowball_id}"
+    logger.info(f'Snowball {snowball_id} from {len(seed_eids)} seeds')
+    state = SnowballState(db_name, snowball_id)
+    for eid in seed_eids:
+        state.push(eid, 0, None, 'seed')
+    state.save()
+    retrieved = 0
+    with SQLiteRecordWriter(db_name, results_table, id_column='eid', keep_existing=('depth',)) as results_writer, \
+            SQLiteRecordWriter(db_name, settings['edges_table'], id_column='edge') as edges_writer:
+        while state.frontier:
+            depth, level = state.next_level()
+            if depth > max_depth:
+                break
+            if budget is not None:
+                level = level[:max(budget - retrieved, 0)]
+                if not level:
+                    logger.info(f'Snowball budget of {budget} retrievals used up')
+                    break
+            logger.info(f'Snowball level {depth}: {len(level)} eids, {len(state.frontier)} in frontier, {len(state.visited)} visited')
+            abstracts = retrieve_scopus_abstracts(level, db_name)
+            retrieved += len(level)
+            for eid in level:
+                ab = abstracts.get(eid)
+                if ab is None:
+                    continue
+                results_writer.write({
+                    'eid': eid, 'doi': ab.doi, 'title': ab.title, 'subtype': ab.subtype, 'date': ab.coverDate,
+                    'abstract': ab.description or ab.abstract, 'depth': depth
+                })
+                if depth == max_depth:
+                    continue
+                if 'backward' in directions:
+                    for ref in ab.references or []:
+                        if not ref.id:
+                            continue
+                        ref_eid = '2-s2.0-' + ref.id
+                        edges_writer.write({'edge': f'{eid}>{ref_eid}', 'eid': eid, 'references_eid': ref_eid})
+                        candidate = {'eid': ref_eid, 'title': ref.title, 'year': ref.publicationyear or ref.coverDate, 'subtype': None}
+                        if prefilter is None or prefilter(candidate):
+                            state.push(ref_eid, depth + 1, eid, 'backward')
+                if 'forward' in directions:
+                    for citing in search_citing_documents(eid):
+                        edges_writer.write({'edge': f'{citing.eid}>{eid}', 'eid': citing.eid, 'references_eid': eid})
+                        candidate = {'eid': citing.eid, 'title': citing.title, 'year': citing.coverDate, 'subtype': citing.subtype}
+                        if prefilter is None or prefilter(candidate):
+                            state.push(citing.eid, depth + 1, eid, 'forward')
+            state.mark_visited([(eid, 'done' if eid in abstracts else 'failed') for eid in level], depth)
+            state.save()
+            results_writer.flush()
+            edges_writer.flush()
+    logger.info(f'Snowball finished with {len(state.visited)} visited eids and {len(state.frontier)} left in frontier')
+    with get_engine(db_name).connect() as connection:
+        exists = connection.exec_driver_sql('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', ('table', results_table)).fetchone()
+        return pd.read_sql(f'select * from {quote(results_table)}', connection) if exists else pd.DataFrame()
+
+
 # Store scopus results in sqlite
-def store_scopus_results_in_sqlite(db_name, table_name, results, mode='replace', id_column=None):
-    if not isinstance(results, pd.DataFrame):
-        # Convert the results to pandas dataframe
-        results = pd.DataFrame(pd.DataFrame(results))
-    # Create a SQLAlchemy engine
-    engine = create_engine(f'sqlite:///{db_name}')
-    # Store the DataFrame in the SQLite database
-    if mode == 'replace':
-        results.to_sql(table_name, engine, if_exists='replace', index=False)
-    elif mode == 'update':
-        insp = reflection.Inspector.from_engine(engine)
-        if table_name in insp.get_table_names():
-            existing_df = pd.read_sql(f'select * from "{table_name}"', engine)
-            results = pd.concat([existing_df, results], axis=0).drop_duplicates(subset=id_column, keep=False)
-        results.to_sql(table_name, engine, if_exists='append', index=False)
-    else:
-        raise NotImplementedError(f'Mode {mode} not implemented')
-    return results
+def store_scopus_results_in_sqlite(db_name, table_name, results, mode='replace', id_column=None, keep_existing=()):
+    # mode 'update' upserts on id_column and returns inserted/updated/unchanged counts
+    return store_records_in_sqlite(db_name, table_name, results, mode=mode, id_column=id_column, keep_existing=keep_existing)
 
@@ -1,38 +1,108 @@
 from semanticscholar import SemanticScholar
-import numpy as np
+from semanticscholar.Paper import Paper
+from semanticscholar.SemanticScholarException import BadQueryParametersException, ObjectNotFoundException
 import pandas as pd
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from config import cfg
 from utils.utils import setup_logger
+from utils.cache import cached_response
+from utils.records import normalize_doi, normalize_title
 
 logger = setup_logger('semantic_scholar', r'.\\logs\\semantic_scholar.log', level=logging.INFO)
 
-def try_find_ss_result(row, ss_results):
-    ss_result = None
+SEMANTIC_SCHOLAR_CONNECTOR_VERSION = 2
+
+def get_paper_fields(endpoint_fields=Paper.FIELDS):
+    # only fields of the field mapping known to the endpoint are requested, unknown fields fail the request
+    # list fields with an entry per citing or cited paper are left out, they would exceed the response limit of a batch
+    fields = []
+    for value in cfg.semantic_scholar['field_mapping']['search_results'].values():
+        fields.extend(value if isinstance(value, list) else [value])
+    excluded = set(cfg.semantic_scholar['batch_excluded_fields'])
+    return [field for field in dict.fromkeys(fields) if field in endpoint_fields and field not in excluded]
+
+@cached_response('semantic_scholar', key=lambda ss, paper_ids, fields: [sorted(paper_ids), fields])
+def get_papers_data(ss: SemanticScholar, paper_ids, fields):
+    try:
+        return [paper.raw_data for paper in ss.get_papers(paper_ids, fields=fields)]
+    except BadQueryParametersException as e:
+        # raised if none of the ids is found
+        logger.warning(f'No papers found for {len(paper_ids)} ids: {e}')
+        return []
+
+def fetch_papers_chunk(ss: SemanticScholar, paper_ids, fields):
+    for attempt in range(1, cfg.semantic_scholar['max_retries'] + 1):
+        try:
+            return get_papers_data(ss, paper_ids, fields)
+        except Exception as e:
+            logger.error(f'Paper batch of {len(paper_ids)} ids raised: {e} (attempt {attempt}/{cfg.semantic_scholar["max_retries"]})')
+        if attempt < cfg.semantic_scholar['max_retries']:
+            time.sleep(cfg.semantic_scholar['retry_delay'] * attempt)
+    return []
+
+def get_papers(ss: SemanticScholar, paper_ids, fields=None):
+    # the batch endpoint takes a limited number of ids per call, chunks are requested concurrently
+    # papers are cached as raw api data and wrapped again on every call
+    fields = fields or get_paper_fields()
+    paper_ids = list(dict.fromkeys(paper_ids))
+    batch_size = cfg.semantic_scholar['batch_size']
+    chunks = [paper_ids[i:i + batch_size] for i in range(0, len(paper_ids), batch_size)]
+    papers = []
+    with ThreadPoolExecutor(max_workers=cfg.semantic_scholar['max_workers']) as executor:
+        for data in executor.map(lambda chunk: fetch_papers_chunk(ss, chunk, fields), chunks):
+            papers.extend(Paper(paper_data) for paper_data in data)
+    logger.info(f'Got {len(papers)} papers for {len(paper_ids)} ids in {len(chunks)} batches')
+    return papers
+
+@cached_response('semantic_scholar_title', key=lambda ss, title, fields: [title, fields])
+def get_paper_data_by_title(ss: SemanticScholar, title, fields):
     try:
-        if 'doi' in row and row['doi']:
-            doi = row['doi']
-            for ss in ss_results:
-                if 'externalIds' in ss.keys() and 'DOI' in ss['externalIds']:
-                    if ss['externalIds']['DOI'] == doi:
-                        logger.info(f'Found ss result for doi {doi}')
-                        return ss
-    except Exception as e:
-        logger.error(f'Error finding ss result for doi {doi}: {e}')
-    logger.info('Try using title')
-    title = row['title']
-    for ss in ss_results:
-        if ss['title'] == title:
-            ss_result = ss
-            logger.info(f'Found ss result for title {title}')
-            break
-    title = title.lower()
-    for ss in ss_results:
-        if ss['title'].lower() == title:
-            ss_result = ss
-            logger.info(f'Found ss result for title {title}')
-            break
-    return ss_result
+        paper = ss.search_paper(title, fields=fields, match_title=True)
+    except ObjectNotFoundException:
+        return None
+    return paper.raw_data
+
+def search_papers_by_title(ss: SemanticScholar, titles):
+    # titles are no valid ids of the batch endpoint, each one is matched on its own
+    fields = get_paper_fields(Paper.SEARCH_FIELDS)
+    papers = []
+    with ThreadPoolExecutor(max_workers=cfg.semantic_scholar['max_workers']) as executor:
+        futures = [executor.submit(get_paper_data_by_title, ss, title, fields) for title in dict.fromkeys(titles)]
+        for future in as_completed(futures):
+            try:
+                data = future.result()
+            except Exception as e:
+                logger.error(f'Title search raised: {e}')
+                continue
+            if data:
+                papers.append(Paper(data))
+    logger.info(f'Matched {len(papers)}/{len(futures)} titles')
+    return papers
+
+
+class PaperIndex:
+    # hash index over papers by normalized doi and title, rows resolve in O(1)
+    def __init__(self, papers=()):
+        self.by_doi = {}
+        self.by_title = {}
+        for paper in papers:
+            self.add(paper)
+
+    def add(self, paper):
+        doi = normalize_doi((paper['externalIds'] or {}).get('DOI')) if 'externalIds' in paper.keys() else None
+        if doi:
+            self.by_doi.setdefault(doi, paper)
+        title = normalize_title(paper['title']) if 'title' in paper.keys() else None
+        if title:
+            self.by_title.setdefault(title, paper)
+
+    def find(self, row):
+        doi = normalize_doi(row['doi']) if 'doi' in row else None
+        if doi and doi in self.by_doi:
+            return self.by_doi[doi]
+        return self.by_title.get(normalize_title(row['title']))
 
 # TODO CONTINUE HERE
 def get_semantic_scholar_value(field, ss_result):
@@ -75,13 +145,14 @@ def get_semantic_scholar_value(field, ss_result):
 def fill_missing_values_using_semantic_scholar(ss: SemanticScholar, df, important_columns_dict):
     # identify rows with important missing values
     missing_values = df[df[list(important_columns_dict.values())].isnull().any(axis=1)]
-    # get paper ids of missing values
-    missing_values_ids = list(np.where(missing_values['doi'].notnull(), missing_values['doi'], missing_values['title']))
-    results = ss.get_papers(missing_values_ids)
+    # rows with a doi are fetched in batches, the other rows are matched by title
+    has_doi = missing_values['doi'].notnull() if 'doi' in missing_values else pd.Series(False, index=missing_values.index)
+    results = get_papers(ss, [f'DOI:{normalize_doi(doi)}' for doi in missing_values.loc[has_doi, 'doi']])
+    results.extend(search_papers_by_title(ss, [title for title in missing_values.loc[~has_doi, 'title'] if isinstance(title, str)]))
+    index = PaperIndex(results)
     # iterate over rows and fill missing values
     for i, missing_values_row in missing_values.iterrows():
-        # TODO get current result from ss
-        ss_item = try_find_ss_result(missing_values_row, results)
+        ss_item = index.find(missing_values_row)
         if ss_item is not None:
             for key in important_columns_dict.keys():
                 if pd.isnull(missing_values_row[important_columns_dict[key]]):
@@ -1,19 +1,25 @@
 import urllib.parse
 import requests
 import logging
-import re
 import time
 import pandas as pd
-from ratelimiter import RateLimiter
-from sqlalchemy import create_engine
-from sqlalchemy.engine import reflection
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from utils.utils import setup_logger
+from utils.cache import cached_response
+from utils.ratelimit import RequestLimiter
+from utils.matcher import BooleanQueryMatcher
+from utils.query import compile_query, parse_search_string, query_groups, to_regex, to_springer_query
+from utils.records import RecordIndex, record_key
+from utils.storage import store_records_in_sqlite
 from config.keys import apikey
 from config.cfg import springer as cfg
 
 logger = setup_logger('springer', r'.\\logs\\springer.log', level=logging.INFO)
 logger.info('Springer module loaded')
 
+TITLE_KEYWORD_FIELDS = ('title', 'keyword')
+SPRINGER_CONNECTOR_VERSION = 1
+
 def build_springer_query(query, start=1, page_length=9999999):
     # https://api.springernature.com/metadata/json?api_key=2d28a6e20dd40a588a79bff2a0b0c082&q=%28%22machine%20learning%22%20OR%20%22deep%20learning%22%20
     # OR%20%22neural%3Fnetwork%22%20OR%20%22learn%2A%20system%22%20OR%20%22virtual%20metrology%22%20OR%20%22artificial%20intelligence%22%20OR%20%22data%20
@@ -27,7 +33,9 @@ def build_springer_query(query, start=1, page_length=9999999):
     query = f"https://api.springernature.com/metadata/json?api_key={apikey['springer']}&q={urllib.parse.quote(query)}&s={start}&p={page_length}"
     return query
 
-@RateLimiter(max_calls=1, period=1)
+@cached_response('springer')
+# one limiter shared by the page fetching threads
+@RequestLimiter(cfg['requests_per_second'])
 def get_results(url):
     response = requests.get(url)
     if response.status_code != 200:
@@ -35,36 +43,30 @@ def get_results(url):
         return None
     return response.json()
 
-def get_term_title_keyword_results(search_string):
+def add_springer_filters(query, criteria):
+    # inclusion criteria as year: and language: constraints, document types are checked locally
+    if not criteria:
+        return query
+    filters = []
+    if 'years' in criteria.native_criteria('springer'):
+        # the api only matches single years, ranges without a first year are checked locally (see 'open_years')
+        year_low, year_high = criteria.years
+        years = range(year_low, year_high + 1)
+        filters.append('(' + ' OR '.join(f'year:{year}' for year in years) + ')' if len(years) > 1 else f'year:{year_high}')
+    languages = criteria.native_languages('springer')
+    if languages:
+        filters.append('(' + ' OR '.join(f'language:{language}' for language in languages) + ')' if len(languages) > 1 else f'language:{languages[0]}')
+    return ' AND '.join([f'({query})'] + filters) if filters else query
+
+def get_term_title_keyword_results(search_string, criteria=None):
     logger.info('Start getting term: TITLE-KEYWORD dictionary')
     search_term_results_dict = {}
-    terms = search_string.strip(' ()').split(') AND (')
-    logger.info(f'Found {len(terms)} terms in search string')
-    for term in terms:
+    groups = query_groups(parse_search_string(search_string))
+    logger.info(f'Found {len(groups)} terms in search string')
+    for term, group in groups:
         logger.info(f'Processing term:\n{term}')
-        # term = term.strip(' ()') #term = term + ' AND -("test eins") OR -"test zwei"'
-        # find negations --> soll: -(title:sometitle)
-        indices_neg = [m.start() for m in re.finditer('-', term)]
-        offset = 0
-        title_term = term
-        logger.info(f'Found {len(indices_neg)} negations in term') if indices_neg else None
-        for index in indices_neg:
-            if title_term[index+offset+1] == '(':
-                title_term = title_term[:index+offset+2] + 'title:' + title_term[index+offset+2:]
-                offset+=6
-            elif title_term[index+offset+1] == '"': # -"some title" --> -(title:"some title")
-                closing_bracket_index = title_term.find('"', index+offset+2)
-                title_term = title_term[:index+offset+1] + '(title:' + title_term[index+offset+1:closing_bracket_index+1] + ')' + title_term[closing_bracket_index+1:]
-                offset+=8
-            else: # -sometitle --> -(title:sometitle)
-                closing_space_index = title_term.find(' ', index+offset+1)
-                if closing_space_index == -1:
-                    closing_space_index = len(title_term)
-                title_term = title_term[:index+offset+1] + '(title:' + title_term[index+offset+1:closing_space_index] + ')' + title_term[closing_space_index:]
-                offset+=8
-        title_term = f"title:{title_term.replace(' OR ', ' OR title:').replace(' AND ', ' AND title:').replace('title:-', '-')}"
-        keyword_term = title_term.replace('title:', 'keyword:')
-        search_term = f'({title_term}) OR ({keyword_term})'
+        # every term searched in title and keyword, negations as -(title:x OR keyword:x)
+        search_term = add_springer_filters(to_springer_query(group, TITLE_KEYWORD_FIELDS), criteria)
         logger.info(f'Final SpringerLink TITLE-KEYWORD search string of term:\n{search_term}')
         search_term_results = get_query_results(search_term)
         search_term_results_dict[term] = search_term_results
@@ -74,39 +76,9 @@ def get_term_title_keyword_results(search_string):
     return search_term_results_dict
 
 
-def get_title_keyword_results(search_string):
+def get_title_keyword_results(search_string, criteria=None):
     logger.info('Starting SpringerLink TITLE-KEYWORD query')
-    final_title_keyword_search_string = []
-    terms = search_string.split(') AND (')
-    logger.info(f'Found {len(terms)} terms in search string')
-    for term in terms:
-        logger.info(f'Processing term:\n{term}')
-        term = term.strip(' ()') #term = term + ' AND -("test eins") OR -"test zwei"'
-        # find negations --> soll: -(title:sometitle)
-        indices_neg = [m.start() for m in re.finditer('-', term)]
-        offset = 0
-        logger.info(f'Found {len(indices_neg)} negations in term') if indices_neg else None
-        for index in indices_neg:
-            if term[index+offset+1] == '(':
-                term = term[:index+offset+2] + 'title:' + term[index+offset+2:]
-                offset+=6
-            elif term[index+offset+1] == '"': # -"some title" --> -(title:"some title")
-                closing_bracket_index = term.find('"', index+offset+2)
-                term = term[:index+offset+1] + '(title:' + term[index+offset+1:closing_bracket_index+1] + ')' + term[closing_bracket_index+1:]
-                offset+=8
-            else: # -sometitle --> -(title:sometitle)
-                closing_space_index = term.find(' ', index+offset+1)
-                if closing_space_index == -1:
-                    closing_space_index = len(term)
-                term = term[:index+offset+1] + '(title:' + term[index+offset+1:closing_space_index] + ')' + term[closing_space_index:]
-                offset+=8
-        title_term = f"title:{term.replace(' OR ', ' OR title:').replace(' AND ', ' AND title:').replace('title:-', '-')}"
-        keyword_term = title_term.replace('title:', 'keyword:')
-        search_term = f'({title_term}) OR ({keyword_term})'
-        logger.info(f'Processed search term: {search_term}')
-        final_title_keyword_search_string.append(search_term)
-    final_title_keyword_search_string = ') AND ('.join(final_title_keyword_search_string)
-    final_title_keyword_search_string = f'({final_title_keyword_search_string})'
+    final_title_keyword_search_string = add_springer_filters(compile_query(search_string, 'springer', TITLE_KEYWORD_FIELDS), criteria)
     logger.info(f'Final SpringerLink TITLE-KEYWORD search string:\n{final_title_keyword_search_string}')
     search_term_results = get_query_results(final_title_keyword_search_string)
     logger.info(f'Finished SpringerLink TITLE-KEYWORD query')
@@ -115,39 +87,17 @@ def get_title_keyword_results(search_string):
 
 def get_query_results(search_term):
     logger.info(f'Getting results for:\n{search_term}')
-    results = []
-    # get first page and determine max pagelength, number of required requests
-    json_results = get_results(build_springer_query(search_term))
-    if not json_results:
-        logger.error(f'First API-call for {search_term} failed')
-        return []
-    results.extend(json_results['records'])
-    hits = int(json_results['result'][0]['total'])
-    page_length = json_results['result'][0]['pageLength']
-    start = int(json_results['result'][0]['start'])
-    logger.info(f'Found {hits} hits')
-    logger.info(f'Continue with page length {page_length}')
-    start += 1
-    while len(results) < hits:
-        json_results = get_results(build_springer_query(search_term, start, page_length))
-        if json_results:
-            results.extend(json_results['records'])
-            logger.info(f'Finished page {start} with {len(results)} results')
-        else:
-            logger.error(f'No results for {search_term} at start {start}')
-            logger.info('Trying again after 5 seconds')
-            time.sleep(5)
-            continue
-        start += 1
-        if start % 4 == 0:
-            # print a progress bar
-            progress = len(results) / hits * 100
-            print(f'Progress of SpringerLink query: [{"#" * int(progress)}{" " * (100 - int(progress))}] {progress:.2f}%')
+    results = get_paged_results(search_term)
     logger.info(f'Finished query with {len(results)} results')
     return results
 
-def get_all_results(search_term):
+def get_all_results(search_term, criteria=None):
     logger.info(f'Start getting ALL-query results for:\n{search_term}')
+    results = get_paged_results(add_springer_filters(compile_query(search_term, 'springer'), criteria))
+    logger.info(f'Finished getting ALL-query results with {len(results)} results')
+    return results
+
+def get_paged_results(search_term):
     results = []
     # get first page and determine max pagelength, number of required requests
     json_results = get_results(build_springer_query(search_term))
@@ -156,123 +106,99 @@ def get_all_results(search_term):
         return []
     results.extend(json_results['records'])
     hits = int(json_results['result'][0]['total'])
-    page_length = json_results['result'][0]['pageLength']
+    page_length = int(json_results['result'][0]['pageLength'])
     start = int(json_results['result'][0]['start'])
     logger.info(f'Found {hits} hits')
     logger.info(f'Continue with page length {page_length}')
-    while len(results) < hits:
-        start += 1
-        json_results = get_results(build_springer_query(search_term, start, page_length))
-        if json_results:
-            results.extend(json_results['records'])
-            logger.info(f'Finished page {start} with {len(results)} results')
-        else:
-            logger.error(f'No results for {search_term} at start {start}')
-        if start % 4 == 0:
-            # print a progress bar
-            progress = len(results) / hits * 100
-            print(f'Progress of SpringerLink query: [{"#" * int(progress)}{" " * (100 - int(progress))}] {progress:.2f}%')
-    logger.info(f'Finished getting ALL-query results with {len(results)} results')
+    if len(results) >= hits or page_length == 0:
+        return results
+    # all remaining page offsets are known after the first page
+    starts = list(range(start + page_length, start + hits, page_length))
+    results.extend(fetch_pages_concurrently(search_term, starts, page_length, hits))
     return results
 
-def get_negative_lookahead_terms(term):
-    if ' AND ' in term:
-        logger.error('AND not supported in negation')
-        return []
-    if ' OR ' in term:
-        terms = term.split(' OR ')
-    else:
-        terms = [term]
-    
-    return terms
+def fetch_pages_concurrently(search_term, starts, page_length, hits):
+    pages = {}
+    failed_starts = []
+    with ThreadPoolExecutor(max_workers=cfg['max_concurrent_requests']) as executor:
+        futures = {executor.submit(fetch_page, search_term, start, page_length): start for start in starts}
+        for future in as_completed(futures):
+            start = futures[future]
+            records = future.result()
+            if records is None:
+                failed_starts.append(start)
+                continue
+            pages[start] = records
+            logger.info(f'Finished page {start} with {len(records)} results ({len(pages)}/{len(starts)} pages)')
+            if len(pages) % 4 == 0:
+                # print a progress bar
+                progress = min(page_length * (len(pages) + 1) / hits * 100, 100)
+                print(f'Progress of SpringerLink query: [{"#" * int(progress)}{" " * (100 - int(progress))}] {progress:.2f}%')
+    if failed_starts:
+        logger.error(f'Giving up on {len(failed_starts)} pages of {search_term} at starts {sorted(failed_starts)}')
+    # reassemble records in page order
+    results = []
+    for start in starts:
+        results.extend(pages.get(start, []))
+    return results
+
+def fetch_page(search_term, start, page_length):
+    # a failed page is retried on its own while the other pages keep going
+    for attempt in range(1, cfg['max_retries'] + 1):
+        try:
+            json_results = get_results(build_springer_query(search_term, start, page_length))
+        except requests.RequestException as e:
+            logger.error(f'Request for {search_term} at start {start} raised: {e}')
+            json_results = None
+        if json_results:
+            return json_results['records']
+        logger.error(f'No results for {search_term} at start {start} (attempt {attempt}/{cfg["max_retries"]})')
+        if attempt < cfg['max_retries']:
+            time.sleep(cfg['retry_delay'] * attempt)
+    return None
 
 def convert_search_string_to_regex(search_string):
+    # one regex per term of the search string, e.g. re.match(regex, text, re.IGNORECASE | re.DOTALL)
     logger.info(f'Start converting single terms of search string to regex')
-    # terms = search_string.strip(' ()').split(') AND (')
-    dict_keys = search_string.strip(' ()').split(') AND (')
-    # search negations
-    regex_expressions_dict = {}
-    terms = search_string.strip(' ()').replace('"', r'\b').replace('?', '.').replace('*', '.*').split(') AND (')
-    logger.info(f'Found {len(terms)} terms in search string')
-    for i, term in enumerate(terms):
-        # term = term.strip(' ()') #term = term + ' AND -("test eins") OR -"test zwei"'
-        # find negations --> soll: -(title:sometitle)
-        indices_neg = [m.start() for m in re.finditer('-', term)]
-        neg_term_slices = []
-        neg_terms = []
-        logger.info(f'Found {len(indices_neg)} negations in term') if indices_neg else None
-        for index in indices_neg:
-            if term[index+1] == '(':
-                closing_bracket_index = term.find(')', index+2)
-                neg_term = term[index+2:closing_bracket_index]
-                neg_lookahead_terms = get_negative_lookahead_terms(neg_term)
-                if neg_lookahead_terms:
-                    neg_terms.extend(neg_lookahead_terms)
-                else:
-                    logging.warning(f'Continue without considering negation {neg_term}')
-                    logging.warning('Unexpected behaviour may occur')
-                    continue
-                neg_term_slices.append((index, closing_bracket_index))
-            else: # -sometitle --> -(title:sometitle)
-                next_and = term.find(' AND ', index+1)
-                next_or = term.find(' OR ', index+1)
-                last_char = len(term)
-                if next_and == -1 and next_or == -1:
-                    end = last_char
-                elif next_and == -1:
-                    end = next_or
-                else: # next_or == -1:
-                    end = next_and
-                neg_terms.extend(get_negative_lookahead_terms(term[index+1:end]))
-                neg_term_slices.append((index, end))
-        if neg_terms:
-            neg_lookahead = f'^(?!.*({"|".join(neg_terms)}))'
-            neg_term_slices = sorted(neg_term_slices, key=lambda x: x[0], reverse=True)
-            for start, end in neg_term_slices:
-                term = term[:start].rstrip(' ').removesuffix('AND').removesuffix('OR') + term[end:]
-            term = term.strip(' ')
-            logger.info(f'Negation lookahead: {neg_lookahead}')
-        else:
-            neg_lookahead = ''
-        # create capture group for each term
-        term = term.replace(' OR ', '|').replace(' AND ', '|')
-        term = f'{neg_lookahead}.*({term}).*'
-        logger.info(f'Final regex search string of term:\n{term}')
-        regex_expressions_dict[dict_keys[i]] = term
+    regex_expressions_dict = {term: to_regex(group) for term, group in query_groups(parse_search_string(search_string))}
     logger.info(f'Finished converting single terms of search string to regex')       
     return regex_expressions_dict
 
 
-def combine_results_to_TITLE_ABS_KEY(all_fields_results, title_keyword_results, terms_title_keyword_results_dict, terms_regex_dict):
+def combine_results_to_TITLE_ABS_KEY(all_fields_results, title_keyword_results, terms_title_keyword_results_dict, abstract_matcher: BooleanQueryMatcher):
     logger.info(f'Start combining results to TITLE-ABSTRACT-KEYWORD results')
     # title_keywords_result are part of total results
     title_abs_key_results = title_keyword_results
     logger.info(f'Found already {len(title_keyword_results)} results using only TITLE and KEYWORD')
-    terms_abstract_results_dict = {term: [] for term in terms_regex_dict.keys()}
+    terms_abstract_index_dict = {term: RecordIndex() for term in abstract_matcher.groups}
     logger.info(f'Starting to search for matching abstracts')
-    for term, regex in terms_regex_dict.items():
-        logger.info(f'Searching matching abstracts for term:\n{term}')
-        for all_fields_res in all_fields_results:
-            if not 'abstract' in all_fields_res:
-                continue
-            if re.match(regex, all_fields_res['abstract'], re.IGNORECASE):
-                terms_abstract_results_dict[term].append(all_fields_res)
-                # TODO überprüfen --> lens* ist das problem
-                # .*(lens.*|reflectance|reflective|anti.reflective|ophtalmic|optoelectronic|optical filter|optical coating|optical film).*
-                # Real-time monitoring lenses of students’ classroom engagement level is of paramount importance in modern education. Facial expression recognition has been extensively explored in various studies to achieve this goal. However, conventional models often grapple with a high number of parameters and substantial computational costs, limiting their practicality in real-time applications and real-world scenarios. To address this limitation, this paper proposes “Light_Fer,” a lightweight model designed to attain high accuracy while reducing parameters. Light_Fer’s novelty lies in the integration of depthwise separable convolution, group convolution, and inverted bottleneck structure. These techniques optimize the models’ architecture, resulting in superior accuracy with fewer parameters. Experimental results demonstrate that Light_Fer, with just 0.23M parameters, achieves remarkable accuracies of 87.81% and 88.20% on FERPLUS and RAF-DB datasets, respectively. Furthermore, by establishing a correlation between facial expressions and students’ engagement levels, we extend the application of Light_Fer to real-time detection and monitoring of students’ engagement during classroom activities. In conclusion, the proposed Light_Fer model, with its lightweight design and enhanced accuracy, offers a promising solution for real-time student engagement monitoring through facial expression recognition.
-        logger.info(f'Found {len(terms_abstract_results_dict[term])} matching abstracts for term')
+    # every abstract is scanned once for the terms of all groups
+    for all_fields_res in all_fields_results:
+        if not 'abstract' in all_fields_res:
+            continue
+        for term in abstract_matcher.matching_groups(all_fields_res['abstract']):
+            terms_abstract_index_dict[term].add(all_fields_res)
+    for term in terms_abstract_index_dict.keys():
+        logger.info(f'Found {len(terms_abstract_index_dict[term])} matching abstracts for term:\n{term}')
+    # a record matches a term if it was found by the TITLE-KEYWORD query or by its abstract
+    terms_index_dict = {
+        term: RecordIndex(terms_title_keyword_results_dict[term]).union(terms_abstract_index_dict[term])
+        for term in terms_abstract_index_dict.keys()
+    }
     # combine abstract results with title_keyword_results
     logger.info(f'Starting to find ALL-results that match with TITLE-KEYWORD OR ABSTRACT results')
+    title_abs_key_index = RecordIndex(title_keyword_results)
     for res in all_fields_results:
-        if res in title_keyword_results:
+        key = record_key(res)
+        if title_abs_key_index.contains_key(key):
             if 'title' in res:
                 logger.info(f'"{res["title"]}" already in title_keyword_results')
             else:
                 logger.info(f'{res}\nalready in title_keyword_results')
             continue
         found = True
-        for term in terms_abstract_results_dict.keys():
-            if not (res in terms_title_keyword_results_dict[term] or res in terms_abstract_results_dict[term]):
+        for term, term_index in terms_index_dict.items():
+            if not term_index.contains_key(key):
                 logger.info(f'{res} not found in "{term}"')
                 found = False
                 break
@@ -282,6 +208,7 @@ def combine_results_to_TITLE_ABS_KEY(all_fields_results, title_keyword_results,
             else:
                 logger.info(f'Added using abstract:\n{res}')
             title_abs_key_results.append(res)
+            title_abs_key_index.add(res)
     logger.info(f'Finished combining results to TITLE-ABSTRACT-KEYWORD results')
     logger.info(f'Found {len(title_abs_key_results)} results')
     return title_abs_key_results
@@ -290,27 +217,21 @@ def combine_results_to_TITLE_ABS_KEY(all_fields_results, title_keyword_results,
     # return results
 
 def store_springer_results_in_sqlite(db_name, table_name, springer_results, mode='replace', id_column=None):
-    if not isinstance(springer_results, pd.DataFrame):
-        # Convert the results to pandas dataframe
-        results = pd.DataFrame(springer_results)
+    if isinstance(springer_results, pd.DataFrame):
+        springer_results = springer_results.to_dict('records')
+    records = (transform_springer_record(record) for record in springer_results)
+    return store_records_in_sqlite(db_name, table_name, records, mode=mode, id_column=id_column)
+
+def transform_springer_record(record):
+    record = dict(record)
     # Transform columns
-    results['creators'] = results['creators'].apply(lambda x: '; '.join([creator['creator'] for creator in x]))
-    results['subjects'] = results['subjects'].apply(lambda x: '; '.join(x))
-    results['url'] = results['url'].apply(lambda x: ' | '.join([url['value'] for url in x]))
-    # Create a SQLAlchemy engine
-    engine = create_engine(f'sqlite:///{db_name}')
-    # Store the DataFrame in the SQLite database
-    if mode == 'replace':
-        results.to_sql(table_name, engine, if_exists='replace', index=False)
-    elif mode == 'update':
-        insp = reflection.Inspector.from_engine(engine)
-        if table_name in insp.get_table_names():
-            existing_df = pd.read_sql(f'select * from "{table_name}"', engine)
-            results = pd.concat([existing_df, results], axis=0).drop_duplicates(subset=id_column, keep=False)
-        results.to_sql(table_name, engine, if_exists='append', index=False)
-    else:
-        raise NotImplementedError(f'Mode {mode} not implemented')
-    return results
+    if isinstance(record.get('creators'), list):
+        record['creators'] = '; '.join([creator['creator'] for creator in record['creators']])
+    if isinstance(record.get('subjects'), list):
+        record['subjects'] = '; '.join(record['subjects'])
+    if isinstance(record.get('url'), list):
+        record['url'] = ' | '.join([url['value'] for url in record['url']])
+    return record
 
 
 # (title:"coat* machine" OR title:"physical vapor deposition" OR title:"physical vapour deposition" OR title:"pvd" OR title:"chemical vapor deposition" OR title:"chemical vapour deposition" OR title:"CVD" OR title:"sputter*" OR title:"evaporation" OR title:"ebeam" AND title:-disease) AND ("thin?film" OR title:"coat*" OR title:"lamination") AND ("lens*" OR title:"reflectance" OR title:"reflective" OR title:"anti?reflective" OR title:"ophtalmic" OR title:"optoelectronic" OR title:"optical filter" OR title:"optical coating" OR title:"optical film") AND (title:"machine learning" OR title:"deep learning" OR title:"neural?network" OR title:"learn* system" OR title:"virtual metrology" OR title:"artificial intelligence" OR title:"data mining" OR title:"data science" OR title:"big data" OR title:predictive*)
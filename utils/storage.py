@@ -0,0 +1,244 @@
+import dataclasses
+import datetime
+import functools
+import json
+import logging
+import os
+import pandas as pd
+from sqlalchemy import create_engine, event
+from utils.utils import setup_logger
+
+logger = setup_logger('storage', r'.\\logs\\storage.log', level=logging.INFO)
+
+DEFAULT_BATCH_SIZE = 500
+# stays below the default limit of host parameters per sqlite statement
+MAX_SELECT_PARAMETERS = 500
+# table a replacement is written to before it is swapped in
+REPLACE_SUFFIX = '__replacement'
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine(db_name):
+    # one pooled engine per database file for the whole run
+    if os.path.dirname(db_name):
+        os.makedirs(os.path.dirname(db_name), exist_ok=True)
+    engine = create_engine(f'sqlite:///{db_name}')
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers continue while pages are written and keeps committed batches on a crash
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    return engine
+
+def quote(identifier):
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+def to_record(item):
+    if isinstance(item, dict):
+        return item
+    if hasattr(item, '_asdict'): # namedtuples, e.g. pybliometrics results
+        return item._asdict()
+    if dataclasses.is_dataclass(item):
+        return dataclasses.asdict(item)
+    return vars(item)
+
+def to_sql_value(value):
+    if value is None or isinstance(value, (str, bytes, bool, int)):
+        return value
+    if isinstance(value, float):
+        return None if value != value else value # NaN
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return None if pd.isnull(value) else value.isoformat()
+    if isinstance(value, (list, tuple, set, dict)):
+        return json.dumps(list(value) if isinstance(value, set) else value, default=str)
+    if hasattr(value, 'item'): # numpy scalars
+        return to_sql_value(value.item())
+    if pd.isnull(value):
+        return None
+    return str(value)
+
+
+class SQLiteRecordWriter:
+    # Writes records to a table in batches as they arrive.
+    # The table is created from the keys of the first batch and extended by new keys later on.
+    # With an id_column, rows are upserted on a unique index of that column: only the stored rows
+    # with the ids of a batch are looked up, and counts tell inserted, updated and unchanged rows apart.
+    # Columns in keep_existing keep their stored value on update (e.g. the iteration a row was first found in).
+    # In mode 'replace' records go to a temporary table that replaces the table when the writer is closed without
+    # an error, a run that fails keeps the previous table.
+    def __init__(self, db_name, table_name, id_column=None, mode='append', batch_size=DEFAULT_BATCH_SIZE, keep_existing=()):
+        if mode not in ('replace', 'append', 'update'):
+            raise NotImplementedError(f'Mode {mode} not implemented')
+        if mode == 'update' and id_column is None:
+            raise ValueError('Mode update requires an id_column')
+        self.db_name = db_name
+        self.mode = mode
+        self.target_table = table_name
+        self.table_name = table_name + REPLACE_SUFFIX if mode == 'replace' else table_name
+        self.id_column = id_column
+        self.batch_size = batch_size
+        self.keep_existing = set(keep_existing)
+        self.engine = get_engine(db_name)
+        self.counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        self._batch = []
+        with self.engine.begin() as connection:
+            if mode == 'replace':
+                # left over by a run that crashed
+                connection.exec_driver_sql(f'DROP TABLE IF EXISTS {quote(self.table_name)}')
+            self.columns = [row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info({quote(self.table_name)})')]
+            if self.columns and id_column is not None:
+                self._ensure_unique_index(connection)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.mode == 'replace':
+            if exc_type is None:
+                self.flush()
+                self._swap()
+            else:
+                with self.engine.begin() as connection:
+                    connection.exec_driver_sql(f'DROP TABLE IF EXISTS {quote(self.table_name)}')
+                logger.error(f'Kept the previous {self.target_table} in {self.db_name}, writing its replacement failed')
+            return False
+        # store everything received so far, also if the producer failed
+        self.flush()
+        return False
+
+    def _swap(self):
+        temporary_table, self.table_name = self.table_name, self.target_table
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS {quote(self.target_table)}')
+            if not self.columns:
+                return
+            connection.exec_driver_sql(f'ALTER TABLE {quote(temporary_table)} RENAME TO {quote(self.target_table)}')
+            if self.id_column is not None:
+                # indexes keep their name on a rename, the index is created again under the name of the table
+                connection.exec_driver_sql(f'DROP INDEX IF EXISTS {quote(temporary_table + "_" + self.id_column)}')
+                self._ensure_unique_index(connection)
+
+    def write(self, record):
+        self._batch.append(to_record(record))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        columns = list(dict.fromkeys(column for record in batch for column in record))
+        rows = [tuple(to_sql_value(record.get(column)) for column in columns) for record in batch]
+        with self.engine.begin() as connection:
+            self._ensure_columns(connection, columns)
+            if self.id_column is None:
+                self.counts['inserted'] += len(rows)
+            else:
+                rows = self._changed_rows(connection, columns, rows)
+            if rows:
+                connection.exec_driver_sql(self._insert_statement(columns), rows)
+        logger.info(f'Wrote {len(rows)} rows to {self.table_name} in {self.db_name}, totals: {self.counts}')
+
+    def _changed_rows(self, connection, columns, rows):
+        if self.id_column not in columns:
+            raise ValueError(f'Records lack the id column {self.id_column}')
+        id_index = columns.index(self.id_column)
+        ids = list({row[id_index] for row in rows if row[id_index] is not None})
+        stored_rows = {}
+        for i in range(0, len(ids), MAX_SELECT_PARAMETERS):
+            chunk = ids[i:i + MAX_SELECT_PARAMETERS]
+            statement = (
+                f'SELECT {", ".join(quote(column) for column in columns)} FROM {quote(self.table_name)} '
+                f'WHERE {quote(self.id_column)} IN ({", ".join("?" for _ in chunk)})'
+            )
+            for stored in connection.exec_driver_sql(statement, tuple(chunk)):
+                stored_rows[stored[id_index]] = tuple(stored)
+        changed_rows = []
+        for row in rows:
+            key = row[id_index]
+            stored = stored_rows.get(key) if key is not None else None
+            if stored is None:
+                self.counts['inserted'] += 1
+            else:
+                row = self._merge(columns, stored, row)
+                if row == stored:
+                    self.counts['unchanged'] += 1
+                    continue
+                self.counts['updated'] += 1
+            # later rows of the same batch with this id compare against this one
+            if key is not None:
+                stored_rows[key] = row
+            changed_rows.append(row)
+        return changed_rows
+
+    def _merge(self, columns, stored, row):
+        # same rules as the upsert statement
+        merged = []
+        for column, stored_value, value in zip(columns, stored, row):
+            if column in self.keep_existing:
+                merged.append(stored_value if stored_value is not None else value)
+            else:
+                merged.append(value if value is not None else stored_value)
+        return tuple(merged)
+
+    def _ensure_columns(self, connection, columns):
+        if not self.columns:
+            connection.exec_driver_sql(f'CREATE TABLE IF NOT EXISTS {quote(self.table_name)} ({", ".join(quote(column) for column in columns)})')
+            self.columns = list(columns)
+            if self.id_column is not None:
+                self._ensure_unique_index(connection)
+            return
+        for column in columns:
+            if column not in self.columns:
+                connection.exec_driver_sql(f'ALTER TABLE {quote(self.table_name)} ADD COLUMN {quote(column)}')
+                self.columns.append(column)
+
+    def _ensure_unique_index(self, connection):
+        # tables written by earlier appends can hold duplicate ids, keep the first row of each
+        index_name = self.table_name + '_' + self.id_column
+        exists = connection.exec_driver_sql('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', ('index', index_name)).fetchone()
+        if exists:
+            return
+        deleted = connection.exec_driver_sql(
+            f'DELETE FROM {quote(self.table_name)} WHERE {quote(self.id_column)} IS NOT NULL AND rowid NOT IN '
+            f'(SELECT MIN(rowid) FROM {quote(self.table_name)} GROUP BY {quote(self.id_column)})'
+        ).rowcount
+        if deleted:
+            logger.warning(f'Removed {deleted} rows with duplicate {self.id_column} from {self.table_name}')
+        connection.exec_driver_sql(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS {quote(index_name)} '
+            f'ON {quote(self.table_name)} ({quote(self.id_column)})'
+        )
+
+    def _insert_statement(self, columns):
+        statement = (
+            f'INSERT INTO {quote(self.table_name)} ({", ".join(quote(column) for column in columns)}) '
+            f'VALUES ({", ".join("?" for _ in columns)})'
+        )
+        if self.id_column is not None:
+            # missing values of a new row do not erase values already stored
+            updates = [
+                f'{quote(column)} = COALESCE({quote(column)}, excluded.{quote(column)})' if column in self.keep_existing
+                else f'{quote(column)} = COALESCE(excluded.{quote(column)}, {quote(column)})'
+                for column in columns if column != self.id_column
+            ]
+            conflict = f'DO UPDATE SET {", ".join(updates)}' if updates else 'DO NOTHING'
+            statement += f' ON CONFLICT ({quote(self.id_column)}) {conflict}'
+        return statement
+
+
+def store_records_in_sqlite(db_name, table_name, records, mode='replace', id_column=None, batch_size=DEFAULT_BATCH_SIZE, keep_existing=()):
+    # records can be any iterable (e.g. a generator yielding pages as they arrive), a list or a DataFrame
+    if isinstance(records, pd.DataFrame):
+        records = records.to_dict('records')
+    with SQLiteRecordWriter(db_name, table_name, id_column=id_column, mode=mode, batch_size=batch_size, keep_existing=keep_existing) as writer:
+        writer.write_many(records)
+    return writer.counts
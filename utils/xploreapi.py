@@ -1,12 +1,180 @@
+import collections
+import itertools
 import math
+import re
 import urllib.request, urllib.parse, urllib.error
 import xml.etree.ElementTree as ET
 import json
 import pathlib
 import time
+import threading
 import pycurl
 import certifi
 from io import BytesIO
+from utils.cache import cached_response, lookup_cached_response, store_cached_response
+from config.cfg import ieee as cfg
+
+
+class XploreHTTPError(Exception):
+
+    # response with a status other than 2xx, raised by the transport so error pages never reach the response cache
+    def __init__(self, status, url, body):
+
+        super().__init__('HTTP ' + str(status) + ' for ' + url)
+        self.status = status
+        self.url = url
+        self.body = body
+
+
+class CurlTransport:
+
+    # HTTP transport with persistent curl handles
+    # a handle keeps its connection alive between requests, so only the first request to a host pays for the TCP and TLS handshake
+    # handles are not thread safe, every thread gets its own
+    def __init__(self, connectTimeout=cfg['connect_timeout'], timeout=cfg['timeout'], maxConnections=cfg['max_connections']):
+
+        self.connectTimeout = connectTimeout
+        self.timeout = timeout
+        self.maxConnections = maxConnections
+        self.local = threading.local()
+
+
+    # creates a handle with the shared options
+    # return pycurl.Curl
+    def newHandle(self):
+
+        handle = pycurl.Curl()
+        handle.setopt(handle.CAINFO, certifi.where())
+        handle.setopt(handle.CONNECTTIMEOUT, self.connectTimeout)
+        handle.setopt(handle.TIMEOUT, self.timeout)
+        handle.setopt(handle.TCP_KEEPALIVE, 1)
+        handle.setopt(handle.NOSIGNAL, 1)
+        handle.setopt(handle.ENCODING, '')
+        return handle
+
+
+    # persistent handle of the calling thread
+    # return pycurl.Curl
+    def handle(self):
+
+        if getattr(self.local, 'handle', None) is None:
+            self.local.handle = self.newHandle()
+        return self.local.handle
+
+
+    # multi handle and easy handles of the calling thread used by getMany
+    # the multi handle owns the connection cache, it is kept so connections survive between calls
+    # return (pycurl.CurlMulti, list of pycurl.Curl)
+    def multiHandles(self, count):
+
+        if getattr(self.local, 'multi', None) is None:
+            self.local.multi = pycurl.CurlMulti()
+            self.local.multi.setopt(pycurl.M_MAXCONNECTS, self.maxConnections)
+            self.local.multiHandles = []
+        handles = self.local.multiHandles
+        while len(handles) < count:
+            handles.append(self.newHandle())
+        return self.local.multi, handles[:count]
+
+
+    # prepares a handle for a request, options of the previous request are reset
+    # return BytesIO receiving the response body
+    def prepare(self, handle, url, postFields=None):
+
+        buffer_obj = BytesIO()
+        handle.setopt(handle.URL, url)
+        handle.setopt(handle.WRITEDATA, buffer_obj)
+        if postFields is None:
+            handle.setopt(handle.HTTPGET, 1)
+        else:
+            handle.setopt(handle.POST, 1)
+            handle.setopt(handle.POSTFIELDS, postFields)
+        return buffer_obj
+
+
+    # raises XploreHTTPError if the finished request did not succeed
+    # pycurl.Curl handle  Handle after perform
+    # string url          Requested URL
+    # BytesIO buffer_obj  Response body
+    def checkStatus(self, handle, url, buffer_obj):
+
+        status = handle.getinfo(pycurl.RESPONSE_CODE)
+        if not 200 <= status < 300:
+            raise XploreHTTPError(status, url, buffer_obj.getvalue().decode('utf-8', 'replace'))
+
+
+    # string url         URL to request
+    # string postFields  Url encoded body of a POST request, GET if None
+    # return bytes: response body, XploreHTTPError for a status other than 2xx
+    def request(self, url, postFields=None):
+
+        handle = self.handle()
+        buffer_obj = self.prepare(handle, url, postFields)
+        try:
+            handle.perform()
+        except pycurl.error:
+            # a broken handle is replaced on the next request
+            handle.close()
+            self.local.handle = None
+            raise
+        self.checkStatus(handle, url, buffer_obj)
+        return buffer_obj.getvalue()
+
+
+    # requests several urls at once on a multi handle, at most maxConnections at a time
+    # list urls   URLs to request
+    # return list: response body per url (bytes, or the pycurl.error or XploreHTTPError of a failed request)
+    def getMany(self, urls):
+
+        urls = list(urls)
+        results = [None] * len(urls)
+        multi, free = self.multiHandles(min(self.maxConnections, len(urls)))
+        free = list(free)
+        pending = list(enumerate(urls))
+        active = 0
+        while pending or active:
+            # keep all free handles busy
+            while pending and free:
+                index, url = pending.pop(0)
+                handle = free.pop()
+                handle.index = index
+                handle.url = url
+                handle.buffer = self.prepare(handle, url)
+                multi.add_handle(handle)
+                active += 1
+            while True:
+                ret, _ = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                queued, succeeded, failed = multi.info_read()
+                for handle in succeeded:
+                    try:
+                        self.checkStatus(handle, handle.url, handle.buffer)
+                        results[handle.index] = handle.buffer.getvalue()
+                    except XploreHTTPError as e:
+                        results[handle.index] = e
+                for handle, errno, errmsg in failed:
+                    results[handle.index] = pycurl.error(errno, errmsg)
+                for handle in succeeded + [item[0] for item in failed]:
+                    multi.remove_handle(handle)
+                    free.append(handle)
+                    active -= 1
+                if queued == 0:
+                    break
+            if active:
+                multi.select(1.0)
+        return results
+
+
+# transport shared by all clients, persistent handles are kept per thread
+defaultTransport = CurlTransport()
+
+# separators between JSON tokens skipped by the incremental reader
+jsonSeparators = re.compile(r'[\s,:]*')
+
+# size of the chunks fed to the incremental XML parser
+xmlChunkSize = 64 * 1024
 
 class XPLORE:
  
@@ -25,11 +193,14 @@ class XPLORE:
     # request auth token
     authTokenEndPoint = "https://ieeexploreapi.ieee.org/api/v1/auth/token"
 
-    def __init__(self, apiKey):
+    def __init__(self, apiKey, transport=None):
 
     	# API key
         self.apiKey = apiKey
 
+        # HTTP transport with persistent connections
+        self.transport = transport or defaultTransport
+
         # auth token
         self.authToken = ''
 
@@ -66,7 +237,7 @@ class XPLORE:
         # data type for results; default is json (other option is xml)
         self.outputType = 'json'
 
-        # data format for results; default is raw (returned string); other option is object
+        # data format for results; default is raw (returned string); other options are object and stream (generator of articles)
         self.outputDataFormat = 'raw'
 
         # default of 25 results returned
@@ -161,6 +332,23 @@ class XPLORE:
                 self.resultsSorting('publication_year', 'asc')
 
 
+    # setting the filters of inclusion criteria the API supports, see filter/selection_criteria.py
+    # InclusionCriteria criteria   Years and document types of the review
+    # return void
+    def inclusionCriteria(self, criteria):
+
+        if criteria.years:
+            startYear, endYear = criteria.years
+            if criteria.year_low is not None:
+                self.resultsFilter('start_year', str(startYear))
+            self.resultsFilter('end_year', str(endYear))
+
+        # content_type takes a single type, several types are checked locally on the results
+        contentTypes = criteria.native_document_types('ieee')
+        if len(contentTypes) == 1:
+            self.resultsFilter('content_type', contentTypes[0])
+
+
     # setting sort order for results
     # string field   Data field used for sorting
     # string order   Sort order for results (ascending or descending)
@@ -655,19 +843,185 @@ class XPLORE:
     # creates the URL for the API call
     # string url  Full URL to pass to API
     # return string: Results from API
+    # token based full text and usage requests are never cached
+    @cached_response('ieee', key=lambda self, url: None if self.requestingFullText or self.requestingUsage else url)
     def queryAPI(self, url):
 
-        buffer_obj = BytesIO()
-        qry_obj = pycurl.Curl()
-        qry_obj.setopt(qry_obj.URL, url)
-        qry_obj.setopt(qry_obj.WRITEDATA, buffer_obj)
-        qry_obj.setopt(qry_obj.CAINFO, certifi.where())
-        qry_obj.perform()
-        qry_obj.close()
-        response = buffer_obj.getvalue()
+        try:
+            response = self.transport.request(url)
+        except XploreHTTPError as e:
+            # an expired token comes with an error status, callAPI requests a new token when it sees the body
+            if (self.requestingFullText or self.requestingUsage) and not self.checkForTokenExpiration(e.body):
+                return e.body
+            raise
         return response.decode('utf-8')
 
 
+    # runs several API calls at once on the transport, cached responses are not requested again
+    # list urls  Full URLs to pass to API
+    # return list: Results from API in the order of urls
+    def queryAPIMany(self, urls):
+
+        urls = list(urls)
+        results = [None] * len(urls)
+        cacheKeys = {}
+        missing = []
+        for index, url in enumerate(urls):
+            cacheKey, value = lookup_cached_response('ieee', None if self.requestingFullText or self.requestingUsage else url)
+            if value is not None:
+                results[index] = value
+            else:
+                cacheKeys[index] = cacheKey
+                missing.append(index)
+
+        for index, response in zip(missing, self.transport.getMany([urls[index] for index in missing])):
+            if isinstance(response, Exception):
+                raise response
+            results[index] = response.decode('utf-8')
+            store_cached_response('ieee', cacheKeys[index], results[index])
+
+        return results
+
+
+    # creates the URL of the search page starting at start, without changing the query state
+    # int start   Position of the first record of the page
+    # return string: full URL for querying the API
+    def buildPageQuery(self, start):
+
+        startRecord, facetApplied = self.startRecord, self.facetApplied
+        self.startRecord = start
+        self.facetApplied = False
+        try:
+            return self.buildQuery()
+        finally:
+            self.startRecord, self.facetApplied = startRecord, facetApplied
+
+
+    # splits a search result page into the total number of records and its articles
+    # string data   Result string from API
+    # return tuple: (total records, iterator of articles as dicts or XML elements)
+    def parsePage(self, data):
+
+        meta = {}
+        articles = self.streamArticles(data, meta)
+        # the total precedes the articles, it is known once the first article is parsed
+        first = next(articles, None)
+        if first is not None:
+            articles = itertools.chain([first], articles)
+        if 'total_records' not in meta and 'totalfound' not in meta:
+            articles = list(articles)
+        total = meta.get('total_records', meta.get('totalfound')) or 0
+        return int(total), articles
+
+
+    # pulls the articles out of a result page one at a time, without building the whole document
+    # string data   Result string or bytes from API
+    # dict meta     Receives the other top level fields of the page (e.g. total_records) as they are parsed
+    # return generator of articles (dicts for JSON, XML elements for XML)
+    def streamArticles(self, data, meta=None):
+
+        meta = {} if meta is None else meta
+        if self.outputType == 'xml':
+            return self.streamXMLArticles(data, meta)
+        return self.streamJSONArticles(data, meta)
+
+
+    # incremental XML parsing, every article element is detached from the tree once it was yielded
+    def streamXMLArticles(self, data, meta):
+
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        root = None
+        depth = 0
+        for offset in range(0, len(data), xmlChunkSize):
+            parser.feed(data[offset:offset + xmlChunkSize])
+            for event, element in parser.read_events():
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                if element.tag == 'article':
+                    yield element
+                    root.remove(element)
+                else:
+                    meta[element.tag] = element.text
+        parser.close()
+
+
+    # incremental JSON reading, the articles array is decoded one article at a time
+    def streamJSONArticles(self, data, meta):
+
+        text = data.decode('utf-8') if isinstance(data, bytes) else data
+        decoder = json.JSONDecoder()
+        skip = lambda i: jsonSeparators.match(text, i).end()
+        i = skip(0)
+        if not text[i:i + 1] == '{':
+            raise ValueError('Result is not a JSON object')
+        i = skip(i + 1)
+        while text[i] != '}':
+            key, i = decoder.raw_decode(text, i)
+            i = skip(i)
+            if key == 'articles' and text[i] == '[':
+                i = skip(i + 1)
+                while text[i] != ']':
+                    article, i = decoder.raw_decode(text, i)
+                    yield article
+                    i = skip(i)
+                i = skip(i + 1)
+            else:
+                meta[key], i = decoder.raw_decode(text, i)
+                i = skip(i)
+
+
+    # iterates over all articles of the search, pages are requested as needed
+    # the first page tells the total number of records, the remaining pages are fetched in parallel
+    # batches that stay within the requests per second of the key
+    # function stopWhen   Called as stopWhen(article, count) before an article is yielded, True ends the iteration
+    # int maxPages        Maximum number of API calls, defaults to the configured quota
+    # return generator of articles
+    def iterateArticles(self, stopWhen=None, maxPages=None):
+
+        maxPages = maxPages or cfg['max_pages']
+        pageSize = self.resultSetMaxCap
+        self.maximumResults(pageSize)
+
+        # send times of the requests within the last second, the first page request counts as well
+        sent = collections.deque([time.time()])
+        total, articles = self.parsePage(self.queryAPI(self.buildPageQuery(self.startRecord)))
+        starts = list(range(self.startRecord + pageSize, total + 1, pageSize))
+        if len(starts) >= maxPages:
+            print("Only the first " + str(maxPages * pageSize) + " of " + str(total) + " records fit into the quota")
+            starts = starts[:maxPages - 1]
+
+        count = 0
+        batchSize = min(self.transport.maxConnections, cfg['requests_per_second'])
+        while True:
+            for article in articles:
+                if stopWhen is not None and stopWhen(article, count):
+                    return
+                count += 1
+                yield article
+
+            if not starts:
+                return
+
+            # a batch waits until it fits into the requests per second of the key with the requests of the last second
+            batch, starts = starts[:batchSize], starts[batchSize:]
+            while True:
+                now = time.time()
+                while sent and sent[0] <= now - 1:
+                    sent.popleft()
+                if len(sent) + len(batch) <= cfg['requests_per_second']:
+                    break
+                time.sleep(sent[0] + 1 - now)
+            sent.extend([time.time()] * len(batch))
+            pages = self.queryAPIMany([self.buildPageQuery(start) for start in batch])
+            articles = itertools.chain.from_iterable(self.parsePage(data)[1] for data in pages)
+
+
     # request chargeable full text token
     # return string: Full text token from API
     def getAuthTokenFromEndpoint(self):
@@ -676,16 +1030,7 @@ class XPLORE:
         post = { 'auth-token': self.authToken, 'apikey': self.apiKey }
         post = urllib.parse.urlencode(post)
 
-        buffer_obj = BytesIO()
-        qry_obj = pycurl.Curl()
-        qry_obj.setopt(qry_obj.URL, url)
-        qry_obj.setopt(qry_obj.WRITEDATA, buffer_obj)
-        qry_obj.setopt(qry_obj.CAINFO, certifi.where())
-        qry_obj.setopt(qry_obj.POST, 1)
-        qry_obj.setopt(qry_obj.POSTFIELDS, post)
-        qry_obj.perform()
-        qry_obj.close()
-        response = buffer_obj.getvalue()
+        response = self.transport.request(url, post)
         return response.decode('utf-8')
 
 
@@ -743,6 +1088,9 @@ class XPLORE:
         if self.outputDataFormat == 'raw':
             return data
 
+        elif self.outputDataFormat == 'stream':
+            return self.streamArticles(data)
+
         elif self.outputDataFormat == 'object':
             
             if self.outputType == 'xml':